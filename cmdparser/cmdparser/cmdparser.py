@@ -85,7 +85,15 @@ versions:
   Override the :meth:`~Token.get_values()` method to return a list of strings
   to match - this list isn't cached so may be entirely dynamic, but note that
   unlike the :class:`AnyToken` class the list of acceptable items must be a
-  finite list. Use of this class allows tab-completion of the values.
+  finite list. Use of this class allows tab-completion of the values. Where
+  the list is very large, also override :meth:`~Token.complete_values()` to
+  look up only those values which start with a partially entered argument.
+
+:class:`CachedToken`
+  A version of :class:`Token` for values which are expensive to obtain -
+  override :meth:`~CachedToken.load_values()` instead of ``get_values()``
+  and the values are cached until the context indicates that they may have
+  changed.
 
 :class:`AnyToken`
   Similar to :class:`Token`, but in this case any string will be accepted so
@@ -95,7 +103,9 @@ versions:
 
 :class:`AnyTokenString`
   Matches all remaining command-line items, and is otherwise similar to
-  :class:`AnyToken`.
+  :class:`AnyToken`. Although any items are accepted, suggestions for the
+  next item can be offered by overriding
+  :meth:`~AnyTokenString.complete_items()`.
 
 For both :class:`AnyToken` and :class:`AnyTokenString`, there is a
 :meth:`~AnyToken.validate()` method which is called just after matching, and
@@ -198,8 +208,11 @@ See the docstrings of these decorators for more information on their use.
 """
 
 
+import bisect
 import itertools
 import shlex
+import timeit
+import weakref
 
 
 class ParseError(Exception):
@@ -214,6 +227,294 @@ class MatchError(Exception):
 
 
 
+class MatchFailure(object):
+    """Returned by :meth:`ParseItem.match_at()` if an item fails to match.
+
+    Building error messages is comparatively expensive and most failures are
+    expected ones (e.g. all but one option of an alternation) whose messages
+    are never used, so the message is only formatted by calling ``str()`` on
+    the instance. Any :class:`ParseItem` instances in ``args`` are converted
+    with ``str()`` before being substituted into ``fmt``.
+    """
+
+    def __init__(self, fmt, *args):
+        self.fmt = fmt
+        self.args = args
+
+
+    def __str__(self):
+        if not self.args:
+            return self.fmt
+        return self.fmt % tuple(str(i) if isinstance(i, ParseItem) else i
+                                for i in self.args)
+
+
+
+class MatchState(object):
+    """State shared by all items for a single call to match a parse tree.
+
+    An instance is created by :meth:`ParseItem.check_match()` and
+    :meth:`ParseItem.get_completions()` and passed to every call of
+    :meth:`ParseItem.match_at()`, which should match child items by calling
+    :meth:`match_item()`.
+
+    Unless ``memoize`` is ``False`` (or ``trace`` is set, as every call should
+    then be traced), this also holds a memo table of results of matching
+    items at given positions, so the same item needn't be matched against
+    the same command-line items more than once (for example, where several
+    options of an alternation start with the same subtree). Entries are
+    keyed on the item, position and whether ``fields`` and ``completions``
+    are being collected, and record the changes made to these so they can
+    be applied again each time the entry is used.
+
+    If ``prefix`` is set, completions need only include values which start
+    with it - see :meth:`ParseItem.get_completions()`.
+    """
+
+    def __init__(self, context=None, trace=None, memoize=True, prefix=None):
+        self.context = context
+        self.trace = trace
+        self.memo = {} if memoize and trace is None else None
+        self.prefix = prefix
+
+
+    def match_item(self, item, items, pos, fields, completions):
+        """Call :meth:`~ParseItem.match_at()` on item, using the memo table.
+
+        Items whose ``memoize`` attribute is ``False`` are never memoized.
+        Both successful matches and failures are recorded, but exceptions
+        are passed out as usual and not recorded.
+        """
+
+        if self.memo is None or not item.memoize:
+            return self.call_match_at(item, items, pos, fields, completions)
+        key = (id(item), pos, fields is not None, completions is not None)
+        entry = self.memo.get(key, None)
+        if entry is None:
+            item_fields = None if fields is None else {}
+            item_completions = None if completions is None else set()
+            result = self.call_match_at(item, items, pos, item_fields,
+                                        item_completions)
+            entry = (result, item_fields, item_completions)
+            self.memo[key] = entry
+        result, item_fields, item_completions = entry
+        apply_match_changes(fields, completions, item_fields, item_completions)
+        return result
+
+
+    def match_root(self, item, items, fields, completions):
+        """Match the root item of the tree against all of items."""
+
+        return self.call_match_at(item, items, 0, fields, completions)
+
+
+    def call_match_at(self, item, items, pos, fields, completions):
+        """Call :meth:`~ParseItem.match_at()` on item without the memo table.
+
+        If the item's class overrides :meth:`~ParseItem.match()` but not
+        :meth:`~ParseItem.match_at()`, the :class:`ParseItem` version is
+        called instead so that the override is still used.
+        """
+
+        if item.overrides_match_only():
+            return ParseItem.match_at(item, items, pos, fields, completions,
+                                      self)
+        return item.match_at(items, pos, fields, completions, self)
+
+
+    def get_values(self, token):
+        """Return the result of :meth:`Token.get_values()` for token."""
+
+        return token.get_values(self.context)
+
+
+    def complete_values(self, token):
+        """Return values of token to add to the completions.
+
+        If a prefix was specified, only those values returned by
+        :meth:`Token.complete_values()` for it, otherwise all values.
+        """
+
+        if self.prefix is None:
+            return self.get_values(token)
+        return token.complete_values(self.prefix, self.context)
+
+
+    def note_exception(self, item):
+        """Called when item raises :class:`MatchError` from ``match()``."""
+
+        pass
+
+
+
+class NodeProfile(object):
+    """Statistics collected for a single parse item by :class:`MatchProfile`.
+
+    The ``calls`` attribute counts calls to match the item, including those
+    satisfied from the memo table, ``failures`` counts those which returned
+    a :class:`MatchFailure` and ``exceptions`` those which raised an exception
+    (including :class:`MatchError` from items which override ``match()``).
+    The ``get_values`` attribute counts calls to :meth:`Token.get_values()`
+    and :meth:`Token.complete_values()`.
+    The ``total_time`` is the cumulative time in seconds spent matching the
+    item, including its children, and ``own_time`` excludes time spent in
+    children.
+    """
+
+    def __init__(self, item):
+        self.item = item
+        self.calls = 0
+        self.failures = 0
+        self.exceptions = 0
+        self.get_values = 0
+        self.total_time = 0.0
+        self.own_time = 0.0
+
+
+
+class MatchProfile(object):
+    """Collects per-item statistics over one or more matches.
+
+    Pass an instance as the ``profile`` parameter of
+    :meth:`ParseItem.check_match()` or :meth:`ParseItem.get_completions()`
+    to collect statistics, which may accumulate over any number of calls.
+    The statistics for each item are :class:`NodeProfile` instances, which
+    can be accessed via :meth:`get_nodes()` or summarised with
+    :meth:`report()`.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+
+
+    def get_node(self, item):
+        """Return :class:`NodeProfile` for item, creating it if required."""
+
+        node = self.nodes.get(id(item), None)
+        if node is None:
+            node = self.nodes[id(item)] = NodeProfile(item)
+        return node
+
+
+    def get_nodes(self, sort_key="own_time"):
+        """Return list of :class:`NodeProfile` in descending sort_key order."""
+
+        return sorted(self.nodes.itervalues(),
+                      key=lambda node: getattr(node, sort_key), reverse=True)
+
+
+    def report(self, limit=20, sort_key="own_time"):
+        """Return a string table of the items with the highest sort_key.
+
+        Times are shown in milliseconds and at most ``limit`` items are
+        included, or all items if ``limit`` is ``None``.
+        """
+
+        lines = ["%-40s %6s %6s %6s %6s %9s %9s"
+                 % ("item", "calls", "fails", "excs", "values", "total ms",
+                    "own ms")]
+        for node in self.get_nodes(sort_key)[:limit]:
+            name = node.item.__class__.__name__ + " " + str(node.item)
+            name = name[:37] + "..." if len(name) > 40 else name
+            lines.append("%-40s %6d %6d %6d %6d %9.3f %9.3f"
+                         % (name, node.calls, node.failures, node.exceptions,
+                            node.get_values, node.total_time * 1000,
+                            node.own_time * 1000))
+        return "\n".join(lines)
+
+
+
+class ProfilingState(MatchState):
+    """Version of :class:`MatchState` which updates a :class:`MatchProfile`.
+
+    This is only used if a profile is passed to the match methods, so there's
+    no overhead from profiling otherwise.
+    """
+
+    def __init__(self, profile, context=None, trace=None, memoize=True,
+                 prefix=None):
+        MatchState.__init__(self, context=context, trace=trace,
+                            memoize=memoize, prefix=prefix)
+        self.profile = profile
+        # Time spent in children of each item currently being matched.
+        self.child_times = []
+
+
+    def profile_call(self, item, func, *args):
+        """Call func with args, updating the statistics for item."""
+
+        node = self.profile.get_node(item)
+        node.calls += 1
+        self.child_times.append(0.0)
+        start = timeit.default_timer()
+        try:
+            result = func(*args)
+        except Exception:
+            node.exceptions += 1
+            raise
+        finally:
+            elapsed = timeit.default_timer() - start
+            node.total_time += elapsed
+            node.own_time += elapsed - self.child_times.pop()
+            if self.child_times:
+                self.child_times[-1] += elapsed
+        if isinstance(result, MatchFailure):
+            node.failures += 1
+        return result
+
+
+    def match_item(self, item, items, pos, fields, completions):
+        """See :meth:`MatchState.match_item()`."""
+
+        return self.profile_call(item, MatchState.match_item, self, item,
+                                 items, pos, fields, completions)
+
+
+    def match_root(self, item, items, fields, completions):
+        """See :meth:`MatchState.match_root()`."""
+
+        return self.profile_call(item, self.call_match_at, item, items, 0,
+                                 fields, completions)
+
+
+    def get_values(self, token):
+        """See :meth:`MatchState.get_values()`."""
+
+        self.profile.get_node(token).get_values += 1
+        return token.get_values(self.context)
+
+
+    def complete_values(self, token):
+        """See :meth:`MatchState.complete_values()`."""
+
+        if self.prefix is None:
+            return self.get_values(token)
+        self.profile.get_node(token).get_values += 1
+        return token.complete_values(self.prefix, self.context)
+
+
+    def note_exception(self, item):
+        """See :meth:`MatchState.note_exception()`."""
+
+        self.profile.get_node(item).exceptions += 1
+
+
+
+def apply_match_changes(fields, completions, item_fields, item_completions):
+    """Merge fields and completions recorded by a memo entry into the caller's.
+
+    The values in ``item_fields`` are appended to those in ``fields``, which
+    has the same effect as if the item had stored them directly.
+    """
+
+    if item_fields:
+        for name, values in item_fields.iteritems():
+            fields.setdefault(name, []).extend(values)
+    if item_completions:
+        completions.update(item_completions)
+
+
+
 class CallTracer(object):
     """Utility class for debugging parse tree call chain."""
 
@@ -238,6 +539,10 @@ class CallTracer(object):
 class ParseItem(object):
     """Base class for all items in a command specification."""
 
+    # Whether match results should be stored in the MatchState memo table - this
+    # is unnecessary for items which are cheap to match.
+    memoize = True
+
     def __str__(self):
         raise NotImplementedError()
 
@@ -275,15 +580,33 @@ class ParseItem(object):
         raise ParseError("alternates not allowed")
 
 
+    def get_first_tokens(self):
+        """Return ``frozenset`` of fixed strings this item must start with.
+
+        This is used to build dispatch tables in :class:`Alternation`, so if
+        the return value isn't ``None`` then the item must fail to match,
+        without side-effects, any command-line whose first item isn't in the
+        set. Items which may match nothing or whose valid values may change
+        should return ``None``, which is the default.
+        """
+        return None
+
+
     def match(self, compare_items, fields=None, completions=None, trace=None,
               context=None):
         """Called during the match process.
 
-        Should attempt to match item's specification against list of
-        command-line items in ``compare_items`` and either return the remains
-        of ``compare_items`` with consumed items removed, or raise
+        Attempts to match item's specification against list of command-line
+        items in ``compare_items`` and either returns the remains of
+        ``compare_items`` with consumed items removed, or raises
         :class:`MatchError` if the command-line doesn't match.
 
+        The items in this module implement :meth:`match_at()` instead and
+        this method is a wrapper around it, but derived classes (including
+        those derived from the items in this module) may still override this
+        method instead. The description of the parameters below applies to
+        both methods.
+
         If the item has consumed a command-line argument, it should store
         it against the item's name in the ``fields`` dict if that parameter is
         not ``None``.
@@ -291,9 +614,9 @@ class ParseItem(object):
         If the ``completions`` field is not ``None`` and ``compare_items`` is
         empty (i.e. just after the matched string) then the item should store a
         list of valid following token strings in ``completions`` (which should
-        be treated as a ``set``) and then raise :class:`MatchError` - this only
-        applies to items which support tab-completion, items which match any
-        string should leave the set alone.
+        be treated as a ``set``) and then fail to match - this only applies to
+        items which support tab-completion, items which match any string
+        should leave the set alone.
 
         The ``trace`` parameter, if supplied, should be a ``list``. As each
         class's ``match()`` function is entered or left, a string representing
@@ -304,13 +627,77 @@ class ParseItem(object):
         example, the :mod:`cmd` integration passes the :class:`cmd.Cmd`
         instance as the context.
 
-        The default is to raise a :class:`MatchError`, derived classes should
-        override this behaviour.
+        The default is to call :meth:`match_at()`.
         """
-        raise MatchError("invalid use of ParseItem (programming error)")
 
+        state = MatchState(context=context, trace=trace, memoize=False)
+        result = self.match_at(compare_items, 0, fields, completions, state)
+        if isinstance(result, MatchFailure):
+            raise MatchError(str(result))
+        return compare_items[result:]
+
+
+    def match_at(self, items, pos, fields, completions, state):
+        """Called during the match process.
 
-    def check_match(self, items, fields=None, trace=None, context=None):
+        This is the same as :meth:`match()` except that the command-line items
+        to match are those from index ``pos`` of ``items`` onwards, and either
+        the index of the first item not consumed is returned or a
+        :class:`MatchFailure` instance instead of raising an exception. The
+        ``trace`` and ``context`` are attributes of ``state``, which is the
+        :class:`MatchState` instance for the current match. Child items
+        should be matched by calling :meth:`MatchState.match_item()`.
+
+        The default calls :meth:`match()` to support derived classes which
+        override that instead. Derived classes should override one of these
+        methods.
+        """
+
+        if self.match.im_func is ParseItem.match.im_func:
+            return MatchFailure("invalid use of ParseItem (programming error)")
+        try:
+            remaining = self.match(items[pos:], fields=fields,
+                                   completions=completions, trace=state.trace,
+                                   context=state.context)
+        except MatchError, e:
+            state.note_exception(self)
+            return MatchFailure("%s", str(e))
+        return len(items) - len(remaining)
+
+
+    @classmethod
+    def overrides_match_only(cls):
+        """Return True if match() is overridden more recently than match_at().
+
+        Derived classes written before :meth:`match_at()` was added override
+        :meth:`match()` instead, including those derived from the classes in
+        this module which implement :meth:`match_at()`. These must be matched
+        by calling :meth:`match()`, as :meth:`MatchState.call_match_at()`
+        does. The result is cached for each class.
+        """
+
+        result = cls.__dict__.get("_overrides_match_only", None)
+        if result is None:
+            for base in cls.__mro__:
+                if "match_at" in base.__dict__:
+                    result = False
+                    break
+                if "match" in base.__dict__:
+                    result = True
+                    break
+            cls._overrides_match_only = result
+        return result
+
+
+    def overrides_match(self, cls):
+        """Return True if match() or match_at() are overridden from cls."""
+
+        return (self.match.im_func is not cls.match.im_func or
+                self.match_at.im_func is not cls.match_at.im_func)
+
+
+    def check_match(self, items, fields=None, trace=None, context=None,
+                    memoize=True, profile=None):
         """Return None if the specified command-line is valid and complete.
 
         If the command-line doesn't match, an appropriate error explaining the
@@ -331,21 +718,33 @@ class ParseItem(object):
 
         The ``context`` parameter is passed into various methods of the
         parse tree instances, which may be useful for derived classes.
+
+        The ``memoize`` parameter may be set to ``False`` to disable the
+        memo table of the :class:`MatchState`, which can be useful if the
+        items in the tree may return different results when called more than
+        once.
+
+        The ``profile`` parameter may be set to a :class:`MatchProfile`
+        instance to collect statistics on the time spent matching each item.
         """
-        try:
-            unparsed = self.match(items, fields=fields, trace=trace,
-                                  context=context)
-            if unparsed:
-                suffix = " ".join(unparsed)
-                suffix = suffix[:29] + "..." if len(suffix) > 32 else suffix
-                return "command invalid somewhere in: %r" % (suffix,)
-            else:
-                return None
-        except MatchError, e:
-            return str(e)
+        if profile is None:
+            state = MatchState(context=context, trace=trace, memoize=memoize)
+        else:
+            state = ProfilingState(profile, context=context, trace=trace,
+                                   memoize=memoize)
+        result = state.match_root(self, items, fields, None)
+        if isinstance(result, MatchFailure):
+            return str(result)
+        elif result < len(items):
+            suffix = " ".join(items[result:])
+            suffix = suffix[:29] + "..." if len(suffix) > 32 else suffix
+            return "command invalid somewhere in: %r" % (suffix,)
+        else:
+            return None
 
 
-    def get_completions(self, items, context=None):
+    def get_completions(self, items, context=None, memoize=True,
+                        profile=None, prefix=None):
         """Return ``set`` of valid tokens to follow partial command-line.
 
         Calling code should typically use this instead of calling
@@ -361,14 +760,25 @@ class ParseItem(object):
         :mod:`cmd` integration is being used, or by application code
         otherwise.
 
+        The partial argument may instead be passed as ``prefix``, in which
+        case tokens may use :meth:`Token.complete_values()` to avoid
+        returning values which don't start with it. This is worthwhile for
+        tokens with very large numbers of values, but not all items honour
+        it so the caller must still filter the result.
+
         The ``context`` parameter is passed into various methods of the
         parse tree instances, which may be useful for derived classes.
+
+        The ``memoize`` and ``profile`` parameters are as for
+        :meth:`check_match()`.
         """
-        try:
-            completions = set()
-            self.match(items, completions=completions, context=context)
-        except MatchError:
-            pass
+        completions = set()
+        if profile is None:
+            state = MatchState(context=context, memoize=memoize, prefix=prefix)
+        else:
+            state = ProfilingState(profile, context=context, memoize=memoize,
+                                   prefix=prefix)
+        state.match_root(self, items, None, completions)
         return completions
 
 
@@ -393,6 +803,12 @@ class Sequence(ParseItem):
             item.finalise()
 
 
+    def get_first_tokens(self):
+        """See :meth:`ParseItem.get_first_tokens()`."""
+
+        return self.items[0].get_first_tokens() if self.items else None
+
+
     def add(self, child):
         """See :meth:`ParseItem.add()`."""
 
@@ -409,16 +825,16 @@ class Sequence(ParseItem):
             raise ParseError("no child item to pop")
 
 
-    def match(self, compare_items, fields=None, completions=None, trace=None,
-              context=None):
-        """See :meth:`ParseItem.match()`."""
+    def match_at(self, items, pos, fields, completions, state):
+        """See :meth:`ParseItem.match_at()`."""
 
-        tracer = CallTracer(trace, self, compare_items)
+        if state.trace is not None:
+            tracer = CallTracer(state.trace, self, items[pos:])
         for item in self.items:
-            compare_items = item.match(compare_items, fields=fields,
-                                       completions=completions, trace=trace,
-                                       context=context)
-        return compare_items
+            pos = state.match_item(item, items, pos, fields, completions)
+            if isinstance(pos, MatchFailure):
+                break
+        return pos
 
 
 
@@ -439,6 +855,12 @@ class Repeater(ParseItem):
             raise ParseError("empty repeater")
 
 
+    def get_first_tokens(self):
+        """See :meth:`ParseItem.get_first_tokens()`."""
+
+        return self.item.get_first_tokens()
+
+
     def add(self, child):
         """See :meth:`ParseItem.add()`."""
 
@@ -450,24 +872,94 @@ class Repeater(ParseItem):
         self.item = child
 
 
-    def match(self, compare_items, fields=None, completions=None, trace=None,
-              context=None):
-        """See :meth:`ParseItem.match()`."""
+    def match_at(self, items, pos, fields, completions, state):
+        """See :meth:`ParseItem.match_at()`."""
 
-        tracer = CallTracer(trace, self, compare_items)
+        if state.memo is not None:
+            return self.match_tails(items, pos, fields, completions, state)
+        tracer = None
+        if state.trace is not None:
+            tracer = CallTracer(state.trace, self, items[pos:])
         repeats = 0
         while True:
-            try:
-                new_items = self.item.match(compare_items, fields=fields,
-                                            completions=completions,
-                                            trace=trace, context=context)
-                compare_items = new_items
-                repeats += 1
-            except MatchError, e:
+            new_pos = state.match_item(self.item, items, pos, fields,
+                                       completions)
+            if isinstance(new_pos, MatchFailure):
                 if repeats == 0:
-                    tracer.fail(e.args[0])
-                    raise
-                return compare_items
+                    if tracer is not None:
+                        tracer.fail(str(new_pos))
+                    return new_pos
+                return pos
+            pos = new_pos
+            repeats += 1
+
+
+    def match_tails(self, items, pos, fields, completions, state):
+        """Version of :meth:`match_at()` used when memoizing.
+
+        As well as the result of matching the item at each position, this
+        records the final result of repeating from each position onwards. If
+        this repeater is later matched from a later position, for example by
+        an enclosing repeater or alternation retrying from a later item, it
+        skips straight to the end instead of matching every repeat again.
+
+        Each entry holds the final position, the fields added by the repeat
+        at that position, all completions added from that position onwards
+        and the entry for the next repeat, so entries form linked lists which
+        share their tails. Using an entry therefore costs nothing more than
+        adding its completions unless fields are being collected, in which
+        case each value is added to the caller's fields in turn.
+        """
+
+        memo = state.memo
+        flags = (fields is not None, completions is not None)
+        visited = []
+        while True:
+            key = ("tail", id(self), pos) + flags
+            tail = memo.get(key, None) if visited else None
+            if tail is not None:
+                self.apply_tail(tail, fields, completions)
+                break
+            item_fields = None if fields is None else {}
+            item_completions = None if completions is None else set()
+            new_pos = state.match_item(self.item, items, pos, item_fields,
+                                       item_completions)
+            apply_match_changes(fields, completions, item_fields,
+                                item_completions)
+            if isinstance(new_pos, MatchFailure):
+                if not visited:
+                    return new_pos
+                tail = (pos, item_fields, item_completions or frozenset(),
+                        None)
+                memo[key] = tail
+                break
+            visited.append((key, item_fields, item_completions))
+            pos = new_pos
+
+        # Record the result of repeating from each visited position, working
+        # backwards so the completions from later positions can be included.
+        final_pos = tail[0]
+        for key, item_fields, item_completions in reversed(visited):
+            later_completions = tail[2]
+            if item_completions:
+                later_completions = later_completions | item_completions
+            tail = (final_pos, item_fields, later_completions, tail)
+            memo[key] = tail
+        return final_pos
+
+
+    def apply_tail(self, tail, fields, completions):
+        """Apply fields and completions of a tail entry and those following."""
+
+        if completions is not None:
+            completions.update(tail[2])
+        if fields is None:
+            return
+        while tail is not None:
+            if tail[1]:
+                for name, values in tail[1].iteritems():
+                    fields.setdefault(name, []).extend(values)
+            tail = tail[3]
 
 
 
@@ -486,8 +978,16 @@ class Subtree(ParseItem):
     completion (i.e. always return no completions), and this can be done by
     setting the ``suppress_completion`` parameter to the constructor to
     ``True``.
+
+    Compiled parse trees are cached at class level, keyed by the spec and
+    ``ident_factory``, so that instances sharing the same specification and
+    factory also share a single parse tree. This means that any tokens
+    returned by the factory must not keep per-instance state while matching.
     """
 
+    # Maps (spec, ident_factory) to compiled parse trees.
+    _tree_cache = {}
+
     def __init__(self, name, spec, ident_factory=None,
                  suppress_completion=False):
         """Construct a new :class:`Subtree` instance.
@@ -509,14 +1009,41 @@ class Subtree(ParseItem):
 
         self.name = name
         self.suppress_completion = suppress_completion
-        # Allow any parsing exceptions to be passed out of constructor.
-        self.parse_tree = parse_spec(spec, ident_factory=ident_factory)
+        self.parse_tree = self.compile_spec(spec, ident_factory)
+
+
+    @classmethod
+    def compile_spec(cls, spec, ident_factory):
+        """Return a parse tree for spec, shared with other identical subtrees.
+
+        Any parsing exceptions are passed out to the caller and nothing is
+        cached in that case. Factories which can't be hashed are supported,
+        but the resultant parse trees aren't cached.
+        """
+
+        key = (spec, ident_factory)
+        try:
+            tree = cls._tree_cache.get(key, None)
+        except TypeError:
+            return parse_spec(spec, ident_factory=ident_factory)
+        if tree is None:
+            tree = parse_spec(spec, ident_factory=ident_factory)
+            tree = cls._tree_cache.setdefault(key, tree)
+        return tree
 
 
     def __str__(self):
         return '<' + str(self.name) + '>'
 
 
+    def get_first_tokens(self):
+        """See :meth:`ParseItem.get_first_tokens()`."""
+
+        if self.overrides_match(Subtree):
+            return None
+        return self.parse_tree.get_first_tokens()
+
+
     def convert(self, args, fields, context):
         """Convert matched items into values for the ``fields`` dictionary.
 
@@ -535,21 +1062,24 @@ class Subtree(ParseItem):
         return args
 
 
-    def match(self, compare_items, fields=None, completions=None, trace=None,
-              context=None):
-        """See :meth:`ParseItem.match()`."""
+    def match_at(self, items, pos, fields, completions, state):
+        """See :meth:`ParseItem.match_at()`."""
 
-        tracer = CallTracer(trace, self, compare_items)
-        subtree_fields = {}
+        if state.trace is not None:
+            tracer = CallTracer(state.trace, self, items[pos:])
+        # Fields are only needed for convert(), which isn't called unless
+        # the caller is collecting fields itself.
+        subtree_fields = None if fields is None else {}
         completions = None if self.suppress_completion else completions
-        new_items = self.parse_tree.match(compare_items, fields=subtree_fields,
-                                          completions=completions, trace=trace,
-                                          context=context)
-        consumed = compare_items[:len(compare_items)-len(new_items)]
+        new_pos = state.match_item(self.parse_tree, items, pos, subtree_fields,
+                                   completions)
+        if isinstance(new_pos, MatchFailure):
+            return new_pos
         if fields is not None:
             field_value = fields.setdefault(str(self), [])
-            field_value.extend(self.convert(consumed, subtree_fields, context))
-        return new_items
+            field_value.extend(self.convert(items[pos:new_pos], subtree_fields,
+                                            state.context))
+        return new_pos
 
 
 
@@ -565,6 +1095,11 @@ class Alternation(ParseItem):
     matches the command line argument(s) will always be consumed even if this
     leads to a MatchError later in the string which wouldn't have occurred had
     the optional item chosen to match nothing instead.
+
+    When finalised, a dispatch table is built mapping the fixed strings which
+    can start each option (see :meth:`~ParseItem.get_first_tokens()`) to the
+    options which may match them, so only those options and any whose start
+    can't be determined in advance need be tried against a given item.
     """
 
     def __init__(self, optional=False):
@@ -576,6 +1111,8 @@ class Alternation(ParseItem):
 
         self.optional = optional
         self.options = []
+        self.dispatch = None
+        self.fallback = None
         self.add_alternate()
 
 
@@ -591,6 +1128,45 @@ class Alternation(ParseItem):
             raise ParseError("empty alternation")
         for option in self.options:
             option.finalise()
+        self.build_dispatch()
+
+
+    def build_dispatch(self):
+        """Build table of candidate options indexed by first item.
+
+        Each candidate list preserves the original order of the options, so
+        the first option to match is the same as without the table.
+        """
+
+        firsts = [option.get_first_tokens() for option in self.options]
+        if all(first is None for first in firsts):
+            self.dispatch = None
+            self.fallback = None
+            return
+        tokens = set()
+        for first in firsts:
+            tokens.update(first or ())
+        self.dispatch = {}
+        for token in tokens:
+            self.dispatch[token] = tuple(option for option, first
+                                         in zip(self.options, firsts)
+                                         if first is None or token in first)
+        self.fallback = tuple(option for option, first
+                              in zip(self.options, firsts) if first is None)
+
+
+    def get_first_tokens(self):
+        """See :meth:`ParseItem.get_first_tokens()`."""
+
+        if self.optional:
+            return None
+        tokens = set()
+        for option in self.options:
+            first = option.get_first_tokens()
+            if first is None:
+                return None
+            tokens.update(first)
+        return frozenset(tokens)
 
 
     def add(self, child):
@@ -612,24 +1188,56 @@ class Alternation(ParseItem):
         self.options.append(Sequence())
 
 
-    def match(self, compare_items, fields=None, completions=None, trace=None,
-              context=None):
-        """See :meth:`ParseItem.match()`."""
+    def match_at(self, items, pos, fields, completions, state):
+        """See :meth:`ParseItem.match_at()`."""
+
+        tracer = None
+        if state.trace is not None:
+            tracer = CallTracer(state.trace, self, items[pos:])
+        options = self.options
+        if self.dispatch is not None and pos < len(items):
+            options = self.dispatch.get(items[pos], self.fallback)
+        failures = {}
+        for option in options:
+            result = option.match_at(items, pos, fields, completions, state)
+            if not isinstance(result, MatchFailure):
+                return result
+            failures[option] = result
+        if self.optional:
+            return pos
+        if tracer is not None:
+            tracer.fail(items[pos:])
+        return AlternationFailure(self, items, pos, state, failures)
+
+
+
+class AlternationFailure(MatchFailure):
+    """Failure of all options of an :class:`Alternation`.
+
+    The message combines those of all the options, including any which were
+    skipped via the dispatch table. These are guaranteed to fail without
+    side-effects, so they're only matched if the message is required, and
+    messages are collected in the original order of the options.
+    """
 
-        tracer = CallTracer(trace, self, compare_items)
+    def __init__(self, alternation, items, pos, state, failures):
+        MatchFailure.__init__(self, "")
+        self.alternation = alternation
+        self.items = items
+        self.pos = pos
+        self.state = state
+        self.failures = failures
+
+
+    def __str__(self):
         errors = set()
-        for option in self.options:
-            try:
-                return option.match(compare_items, fields=fields,
-                                    completions=completions,
-                                    trace=trace, context=context)
-            except MatchError, e:
-                errors.add(str(e))
-        if self.optional:
-            return compare_items
-        else:
-            tracer.fail(compare_items)
-            raise MatchError(" and ".join(errors))
+        for option in self.alternation.options:
+            failure = self.failures.get(option, None)
+            if failure is None:
+                failure = option.match_at(self.items, self.pos, None, None,
+                                          self.state)
+            errors.add(str(failure))
+        return " and ".join(errors)
 
 
 
@@ -646,6 +1254,8 @@ class Token(ParseItem):
     a list of possible options.
     """
 
+    memoize = False
+
     def __init__(self, name, token=None):
         """Construct a new :class:`Token` instance.
 
@@ -674,6 +1284,19 @@ class Token(ParseItem):
             return "<" + self.name + ">"
 
 
+    def get_first_tokens(self):
+        """See :meth:`ParseItem.get_first_tokens()`.
+
+        Only fixed tokens are included - derived classes which override
+        :meth:`get_values()` or :meth:`~ParseItem.match()` may match
+        different values over time, so return ``None``.
+        """
+        if (self.get_values.im_func is not Token.get_values.im_func or
+                self.overrides_match(Token)):
+            return None
+        return frozenset((self.token,))
+
+
     def get_values(self, context):
         """Return the current list of valid tokens.
 
@@ -688,6 +1311,18 @@ class Token(ParseItem):
         return [self.token]
 
 
+    def complete_values(self, prefix, context):
+        """Return the valid tokens which start with ``prefix``.
+
+        This is used when generating completions for a partially entered
+        argument. The base class version filters the result of
+        :meth:`get_values()`, but derived classes with many values may
+        override it to use a more efficient lookup such as a
+        :class:`PrefixIndex` or an indexed database query.
+        """
+        return [i for i in self.get_values(context) if i.startswith(prefix)]
+
+
     def convert(self, arg, context):
         """Argument conversion hook.
 
@@ -704,31 +1339,150 @@ class Token(ParseItem):
         return [arg]
 
 
-    def match(self, compare_items, fields=None, completions=None, trace=None,
-              context=None):
-        """See :meth:`ParseItem.match()`."""
+    def match_at(self, items, pos, fields, completions, state):
+        """See :meth:`ParseItem.match_at()`."""
 
-        tracer = CallTracer(trace, self, compare_items)
-        if not compare_items:
+        tracer = None
+        if state.trace is not None:
+            tracer = CallTracer(state.trace, self, items[pos:])
+        if pos >= len(items):
             if completions is not None:
-                completions.update(self.get_values(context))
-            tracer.fail([])
-            raise MatchError("insufficient args for %r" % (str(self),))
-        arg = compare_items[0]
-        for value in self.get_values(context):
-            if arg == value:
-                if fields is not None:
-                    arg_list = fields.setdefault(str(self), [])
-                    arg_list.extend(self.convert(arg, context))
-                return compare_items[1:]
-        tracer.fail(compare_items)
-        raise MatchError("%r doesn't match %r" % (arg, str(self)))
+                completions.update(state.complete_values(self))
+            if tracer is not None:
+                tracer.fail([])
+            return MatchFailure("insufficient args for %r", self)
+        arg = items[pos]
+        if arg in state.get_values(self):
+            if fields is not None:
+                arg_list = fields.setdefault(str(self), [])
+                arg_list.extend(self.convert(arg, state.context))
+            return pos + 1
+        if tracer is not None:
+            tracer.fail(items[pos:])
+        return MatchFailure("%r doesn't match %r", arg, self)
+
+
+
+class PrefixIndex(object):
+    """Sorted array of strings which supports fast prefix queries.
+
+    This may be used by tokens with large numbers of values to implement
+    :meth:`Token.complete_values()`. The values are sorted once on
+    construction, after which :meth:`get_prefixed()` uses a binary search
+    so its cost depends only on the number of values returned.
+    """
+
+    def __init__(self, values):
+        self.values = sorted(set(values))
+
+
+    def __len__(self):
+        return len(self.values)
+
+
+    def __iter__(self):
+        return iter(self.values)
+
+
+    def get_prefixed(self, prefix):
+        """Return sorted list of values which start with prefix."""
+
+        values = self.values
+        start = bisect.bisect_left(values, prefix)
+        end = start
+        while end < len(values) and values[end].startswith(prefix):
+            end += 1
+        return values[start:end]
+
+
+
+class CachedToken(Token):
+    """Token whose list of valid values is cached.
+
+    This is intended as a base class for tokens whose values are expensive to
+    obtain, such as those read from a database. Derived classes should
+    override :meth:`load_values()` instead of :meth:`~Token.get_values()`.
+    The values are stored in a ``frozenset`` so matching an argument is a
+    simple membership test, and a :class:`PrefixIndex` of them is built
+    when first used to complete a partial argument.
+
+    The cache is invalidated whenever the value returned by
+    :meth:`get_cache_version()` changes, a different context is passed or
+    :meth:`invalidate()` is called.
+    By default this calls a ``get_data_version()`` method on the context,
+    which should return a value that changes whenever the values may have
+    changed. If the context has no such method, values aren't cached.
+    """
+
+    def __init__(self, name, token=None):
+        """See :meth:`Token.__init__()`."""
+
+        Token.__init__(self, name, token)
+        self.cache = None
+        self.index = None
+
+
+    def load_values(self, context):
+        """Return an iterable of the current valid tokens.
+
+        Derived classes should override this method, which is only called
+        when the cached values are out of date.
+        """
+        return [self.token]
+
+
+    def get_cache_version(self, context):
+        """Return value which changes when the valid tokens may change.
+
+        Returning ``None`` disables caching. The base class version returns
+        the result of ``context.get_data_version()`` if the context has such
+        a method, or ``None`` otherwise.
+        """
+        get_data_version = getattr(context, "get_data_version", None)
+        return None if get_data_version is None else get_data_version()
+
+
+    def invalidate(self):
+        """Discard any cached values."""
+
+        self.cache = None
+        self.index = None
+
+
+    def get_values(self, context):
+        """Return ``frozenset`` of the current valid tokens."""
+
+        version = self.get_cache_version(context)
+        if version is None:
+            return frozenset(self.load_values(context))
+        cache = self.cache
+        if cache is None or cache[0]() is not context or cache[2] != version:
+            values = frozenset(self.load_values(context))
+            try:
+                self.cache = cache = (weakref.ref(context), values, version)
+            except TypeError:
+                return values
+        return cache[1]
+
+
+    def complete_values(self, prefix, context):
+        """See :meth:`Token.complete_values()`."""
+
+        values = self.get_values(context)
+        if self.cache is None or self.cache[1] is not values:
+            # Not cached, so an index would only be used once.
+            return Token.complete_values(self, prefix, context)
+        if self.index is None or self.index[0] is not values:
+            self.index = (values, PrefixIndex(values))
+        return self.index[1].get_prefixed(prefix)
 
 
 
 class AnyToken(ParseItem):
     """Matches any single item."""
 
+    memoize = False
+
     def __init__(self, name):
         """Construct a new :class:`AnyToken` instance.
 
@@ -775,20 +1529,23 @@ class AnyToken(ParseItem):
         return [arg]
 
 
-    def match(self, compare_items, fields=None, completions=None, trace=None,
-              context=None):
-        """See :meth:`ParseItem.match()`."""
-
-        tracer = CallTracer(trace, self, compare_items)
-        if not compare_items:
-            tracer.fail([])
-            raise MatchError("insufficient args for %r" % (str(self),))
-        arg = compare_items[0]
-        if not self.validate(arg, context):
-            raise MatchError("%r is not a valid %s" % (arg, str(self)))
+    def match_at(self, items, pos, fields, completions, state):
+        """See :meth:`ParseItem.match_at()`."""
+
+        tracer = None
+        if state.trace is not None:
+            tracer = CallTracer(state.trace, self, items[pos:])
+        if pos >= len(items):
+            if tracer is not None:
+                tracer.fail([])
+            return MatchFailure("insufficient args for %r", self)
+        arg = items[pos]
+        if not self.validate(arg, state.context):
+            return MatchFailure("%r is not a valid %s", arg, self)
         if fields is not None:
-            fields.setdefault(str(self), []).extend(self.convert(arg, context))
-        return compare_items[1:]
+            fields.setdefault(str(self), []).extend(self.convert(arg,
+                                                                 state.context))
+        return pos + 1
 
 
 
@@ -849,8 +1606,12 @@ class AnyTokenString(ParseItem):
 
     This class will match all remaining command-line arguments and then either
     accept or reject them based on the result of the :meth:`validate()` method.
+    Derived classes may also suggest values for the next argument by
+    overriding :meth:`complete_items()`.
     """
 
+    memoize = False
+
     def __init__(self, name):
         """Construct a new :class:`IntegerToken` instance.
 
@@ -899,22 +1660,40 @@ class AnyTokenString(ParseItem):
         return items
 
 
-    def match(self, compare_items, fields=None, completions=None, trace=None,
-              context=None):
-        """See :meth:`ParseItem.match()`."""
+    def complete_items(self, items, prefix, context):
+        """Completion hook.
 
-        tracer = CallTracer(trace, self, compare_items)
-        if not compare_items:
-            raise MatchError("insufficient args for %r" % (str(self),))
-        if not self.validate(compare_items, context):
+        Return a list of values which may follow the arguments in ``items``,
+        which are those already entered for this item and may be empty. Only
+        values starting with ``prefix`` need be returned. The base class
+        version returns an empty list, as any string is accepted.
+        """
+        return []
+
+
+    def match_at(self, items, pos, fields, completions, state):
+        """See :meth:`ParseItem.match_at()`."""
+
+        tracer = None
+        if state.trace is not None:
+            tracer = CallTracer(state.trace, self, items[pos:])
+        if completions is not None:
+            completions.update(self.complete_items(items[pos:],
+                                                   state.prefix or "",
+                                                   state.context))
+        if pos >= len(items):
+            return MatchFailure("insufficient args for %r", self)
+        compare_items = items[pos:]
+        if not self.validate(compare_items, state.context):
             args = " ".join(compare_items)
             args = args[:20] + "[...]" if len(args) > 25 else args
-            tracer.fail([])
-            raise MatchError("%r is not a valid %s" % (args, str(self)))
+            if tracer is not None:
+                tracer.fail([])
+            return MatchFailure("%r is not a valid %s", args, self)
         if fields is not None:
             arg_list = fields.setdefault(str(self), [])
-            arg_list.extend(self.convert(compare_items, context))
-        return []
+            arg_list.extend(self.convert(compare_items, state.context))
+        return len(items)
 
 
 
@@ -938,6 +1717,11 @@ def parse_spec(spec, ident_factory=None):
       An identifer, by default :class:`AnyToken` unless ``ident_factory``
       returns something different.
 
+    <ident...>
+      An identifier which matches all remaining items, always an
+      :class:`AnyTokenString`. To customise this, use a plain identifier
+      for which ``ident_factory`` returns a class derived from it.
+
     x y z
       A sequence must match all items in turn.
 
@@ -1056,8 +1840,18 @@ class CmdClassDecorator(object):
     which has used the CmdMethodDecorator at least once should also have its
     class definition decorated with this decorator (unless you don't want to
     use cmdparser's automatic tab-completion support).
+
+    Parse trees for commands are built on demand when the command is first
+    executed or completed. If ``check_specs`` is ``True`` then all command
+    specifications are instead compiled and checked immediately, raising
+    :class:`ParseError` if any are invalid - see :func:`check_cmd_specs()`.
     """
 
+    def __init__(self, check_specs=False):
+
+        self.check_specs = check_specs
+
+
     def __call__(self, cls):
 
         for method in dir(cls):
@@ -1068,6 +1862,9 @@ class CmdClassDecorator(object):
                 #       to a so that each completer gets its own closure.
                 method_dec.add_completer(cls)
 
+        if self.check_specs:
+            check_cmd_specs(cls)
+
         return cls
 
 
@@ -1084,14 +1881,49 @@ class CmdMethodDecorator(object):
     This decorator also marks the method as requiring completion, suitable for
     the later class decorator to insert a completion method - unless the class
     decorator is also used, however, tab-completion won't be enabled.
+
+    The command specification is extracted from the docstring immediately,
+    but it's only compiled into a parse tree when the command is first
+    executed or completed, since applications with many commands typically
+    only use a few of them in any one session. Call :meth:`check_spec()` to
+    compile and check the specification earlier.
+
+    Completions are cached if the :class:`cmd.Cmd` instance has a
+    ``get_data_version()`` method, as described for :class:`CachedToken` -
+    see :meth:`complete()`.
+
+    If a command doesn't match its specification, an error and the expected
+    syntax are printed. Applications can report these differently by adding
+    a ``syntax_error(error, parse_tree)`` method to the :class:`cmd.Cmd`
+    class, whose return value is returned from the command.
     """
 
+    # Maximum number of cached completions before the cache is cleared.
+    completion_cache_size = 32
+
     def __init__(self, token_factory=None):
 
         self.token_factory = token_factory
-        self.parse_tree = None
         self.command_string = None
         self.new_docstring = None
+        self.spec = None
+        self._parse_tree = None
+        self.completion_cache = {}
+        self.completion_context = None
+
+
+    @property
+    def parse_tree(self):
+        """Parse tree for the command, compiled on first access."""
+
+        if self._parse_tree is None:
+            self._parse_tree = self.build_parse_tree()
+        return self._parse_tree
+
+
+    @parse_tree.setter
+    def parse_tree(self, value):
+        self._parse_tree = value
 
 
     def __call__(self, method):
@@ -1102,8 +1934,8 @@ class CmdMethodDecorator(object):
                              % (method.func_name,))
         self.command_string = method.func_name[3:]
 
-        # Parse method doc string to obtain parse tree and reformatted
-        # docstring.
+        # Parse method doc string to obtain command spec and reformatted
+        # docstring - the parse tree itself is built on first use.
         self.parse_docstring(method.__doc__)
 
         # Build replacement method.
@@ -1115,12 +1947,15 @@ class CmdMethodDecorator(object):
                                                 context=cmd_self)
             if check is None:
                 return method(cmd_self, split_args, fields)
-            else:
-                print "Error: %s" % (check,)
-                print "Expected syntax: %s" % (self.parse_tree,)
-
-        # Ensure wrapper has correct docstring, and also store away the parse
-        # tree for the class wrapper to use for building completer methods.
+            syntax_error = getattr(cmd_self, "syntax_error", None)
+            if syntax_error is not None:
+                return syntax_error(check, self.parse_tree)
+            print "Error: %s" % (check,)
+            print "Expected syntax: %s" % (self.parse_tree,)
+
+        # Ensure wrapper has correct docstring, and also store away the
+        # decorator for the class wrapper to use for building completer
+        # methods.
         wrapper.__doc__ = "\n" + self.new_docstring + "\n"
         wrapper._cmdparser_decorator = self
 
@@ -1128,7 +1963,7 @@ class CmdMethodDecorator(object):
 
 
     def parse_docstring(self, docstring):
-        """Parse method docsstring and return (parse_tree, new_docstring)."""
+        """Parse method docstring and store (spec, new_docstring)."""
 
         # Reflow docstring to remove unnecessary whitespace.
         common_indent = None
@@ -1169,10 +2004,14 @@ class CmdMethodDecorator(object):
         spec = " ".join(itertools.takewhile(lambda x: x, new_doc))
         if not spec:
             raise ParseError("%s: no command spec" % (self.command_string,))
+        self.spec = spec
+
+
+    def build_parse_tree(self):
+        """Compile and check the command spec, returning the parse tree."""
 
-        # Convert specification into parse tree.
         try:
-            tree = parse_spec(spec, ident_factory=self.token_factory)
+            tree = parse_spec(self.spec, ident_factory=self.token_factory)
             starts = tree.get_completions([])
             if len(starts) != 1:
                 raise ParseError("command spec must have unique initial token")
@@ -1182,9 +2021,13 @@ class CmdMethodDecorator(object):
                                  " command" % (self.command_string, token))
         except ParseError, e:
             raise ParseError("%s: %s" % (self.command_string, e))
+        return tree
+
 
-        # Store parse tree.
-        self.parse_tree = tree
+    def check_spec(self):
+        """Compile the command spec now, raising ParseError if invalid."""
+
+        self.parse_tree
 
 
     def add_completer(self, cls):
@@ -1192,10 +2035,101 @@ class CmdMethodDecorator(object):
 
         def completer_method(cmd_self, text, line, begidx, endidx):
             items = shlex.split(line[:begidx])
+            return self.complete(cmd_self, items, text)
+
+        setattr(cls, "complete_" + self.command_string, completer_method)
+
+
+    def complete(self, context, items, text):
+        """Return list of completions of text following command-line items.
+
+        If the context has a ``get_data_version()`` method, the result is
+        cached against the items and the data version. Readline calls the
+        completer repeatedly as an argument is typed, so if the same items
+        are completed again with the same text, or text which extends it,
+        the cached list is simply filtered rather than matching the parse
+        tree again. Only a weak reference to the context is held, and the
+        cache is cleared if completing for a different context.
+        """
+
+        get_data_version = getattr(context, "get_data_version", None)
+        if get_data_version is None:
             completions = self.parse_tree.get_completions(items,
-                                                          context=cmd_self)
+                                                          context=context,
+                                                          prefix=text)
             return [i for i in completions if i.startswith(text)]
 
-        setattr(cls, "complete_" + self.command_string, completer_method)
+        if (self.completion_context is None or
+            self.completion_context() is not context):
+            self.completion_cache.clear()
+            try:
+                self.completion_context = weakref.ref(context)
+            except TypeError:
+                self.completion_context = None
+        key = (tuple(items), get_data_version())
+        entry = self.completion_cache.get(key, None)
+        if entry is not None and text.startswith(entry[0]):
+            if text == entry[0]:
+                return list(entry[1])
+            return [i for i in entry[1] if i.startswith(text)]
+
+        completions = self.parse_tree.get_completions(items, context=context,
+                                                      prefix=text)
+        completions = [i for i in completions if i.startswith(text)]
+        if len(self.completion_cache) >= self.completion_cache_size:
+            self.completion_cache.clear()
+        self.completion_cache[key] = (text, completions)
+        return list(completions)
+
+
+
+def check_cmd_specs(cls):
+    """Compile and check the command specs of all decorated methods of cls.
+
+    As :class:`CmdMethodDecorator` defers building parse trees until they're
+    first needed, errors in command specifications would otherwise only be
+    detected when the command is used. This function is intended for use in
+    unit tests or debug modes of applications and raises :class:`ParseError`
+    for the first invalid command specification found.
+    """
+
+    for method in dir(cls):
+        method_dec = getattr(getattr(cls, method), "_cmdparser_decorator",
+                             None)
+        if method_dec is not None:
+            method_dec.check_spec()
+
+
+
+def profile_cmd_line(cmd_instance, line, complete=False, profile=None):
+    """Profile matching of a command line by a decorated :class:`cmd.Cmd`.
+
+    The command is looked up as :meth:`cmd.Cmd.onecmd()` would and its parse
+    tree used to check the remainder of the line, or to generate completions
+    for it if ``complete`` is ``True``, without executing the command. The
+    :class:`MatchProfile` is returned - if ``profile`` is specified then
+    statistics are added to that instance, otherwise a new one is created.
+    Use :meth:`MatchProfile.report()` to show the items which took longest.
+
+    Raises ``ValueError`` if the command doesn't exist or doesn't use
+    :class:`CmdMethodDecorator`.
+    """
+
+    command, args, line = cmd_instance.parseline(line)
+    method = getattr(cmd_instance, "do_" + (command or ""), None)
+    method_dec = getattr(method, "_cmdparser_decorator", None)
+    if method_dec is None:
+        raise ValueError("%r is not a cmdparser command" % (command,))
+    items = [method_dec.command_string] + shlex.split(args)
+    if profile is None:
+        profile = MatchProfile()
+    if complete:
+        method_dec.parse_tree.get_completions(items, context=cmd_instance,
+                                              profile=profile)
+    else:
+        method_dec.parse_tree.check_match(items, fields={},
+                                          context=cmd_instance,
+                                          profile=profile)
+    return profile
 
 
@@ -8,10 +8,65 @@ to be as broad as possible, but quite specific to the English language.
 
 
 import datetime
+import re
 import time
 
 import cmdparser
 
+# StrptimeToken compiles its formats using the same internals as
+# time.strptime() itself, which are private to CPython's _strptime module.
+# If they aren't available, each format is simply tried in turn.
+try:
+    from _strptime import TimeRE, _getlang
+except ImportError:
+    TimeRE = _getlang = None
+
+
+# Matches named groups in patterns generated by _strptime.TimeRE.
+STRPTIME_GROUP_RE = re.compile(r"(?<!\\)\(\?P<\w+>")
+
+
+
+def get_now(context):
+    """Return the current time as a :class:`~datetime.datetime`.
+
+    If the context passed to the parse tree has a ``get_now()`` method, such
+    as :class:`FixedTimeContext`, its result is used instead of the system
+    clock so that relative phrases can be evaluated against a fixed time.
+    """
+    context_now = getattr(context, "get_now", None)
+    if context_now is None:
+        return datetime.datetime.now()
+    return context_now()
+
+
+
+def get_today(context):
+    """Return the current :class:`~datetime.date` - see :func:`get_now()`."""
+
+    context_now = getattr(context, "get_now", None)
+    if context_now is None:
+        return datetime.date.today()
+    return context_now().date()
+
+
+
+class FixedTimeContext(object):
+    """Match context which fixes the time used to interpret relative phrases.
+
+    Pass an instance as the ``context`` parameter of
+    :meth:`~cmdparser.ParseItem.check_match()` so that phrases such as
+    ``yesterday`` or ``3 hours ago`` are relative to ``now`` rather than
+    to the time at which each phrase happens to be converted.
+    """
+
+    def __init__(self, now):
+        self.now = now
+
+
+    def get_now(self):
+        return self.now
+
 
 class StrptimeToken(cmdparser.AnyToken):
     """Matches one of a set of strftime() format strings.
@@ -26,6 +81,16 @@ class StrptimeToken(cmdparser.AnyToken):
     where ``-`` is replaced by ``/`` (or vice versa) and/or ``:`` is replaced
     by ``.`` (or vice versa). So, if the time format ``"%Y-%m-%d"`` is provided
     then implicitly ``"%Y/%m/%d"`` will also match.
+
+    To avoid calling :func:`time.strptime()` for every format in turn, the
+    formats are compiled into a single regular expression with a named group
+    per format, using the same locale-specific month and weekday names as
+    :func:`time.strptime()` itself. Arguments which don't match this are
+    rejected immediately, and otherwise only those formats which match are
+    tried. The most recent conversion is also remembered, as a successful
+    match converts the same argument twice. If the interpreter doesn't
+    provide the :mod:`_strptime` internals this relies on, the formats are
+    instead all tried with :func:`time.strptime()`.
     """
 
     def __init__(self, name, time_formats):
@@ -40,14 +105,70 @@ class StrptimeToken(cmdparser.AnyToken):
 
         cmdparser.AnyToken.__init__(self, name)
         self.time_formats = list(alts(alts(time_formats, "-", "/"), ":", "."))
+        self.compiled = None
+        self.last_conversion = None
+
+
+    def compile_formats(self):
+        """Return (regex, format_regexes) for the current locale.
+
+        The first item matches an argument if any of the formats do, with the
+        index of the first such format in the name of the matching group.
+        The second is a list of regular expressions for each format. Returns
+        ``None`` if the formats can't be compiled.
+        """
+
+        if TimeRE is None:
+            return None
+        lang = _getlang()
+        compiled = self.compiled
+        if compiled is None or compiled[0] != lang:
+            time_re = TimeRE()
+            # Only the groups for each format are required, and Python
+            # limits the number of groups in an expression.
+            patterns = [STRPTIME_GROUP_RE.sub("(?:", time_re.pattern(fmt))
+                        for fmt in self.time_formats]
+            regex = "|".join("(?P<f%d>%s)" % (i, pattern)
+                             for i, pattern in enumerate(patterns))
+            compiled = (lang,
+                        re.compile(r"(?:%s)\Z" % (regex,), re.IGNORECASE),
+                        [re.compile(pattern + r"\Z", re.IGNORECASE)
+                         for pattern in patterns])
+            self.compiled = compiled
+        return compiled[1:]
+
+
+    def validate(self, arg, context):
+        """See :meth:`AnyToken.validate()`."""
+
+        compiled = self.compile_formats()
+        if compiled is not None and compiled[0].match(arg) is None:
+            return False
+        return cmdparser.AnyToken.validate(self, arg, context)
 
 
     def convert(self, arg, context):
-        for time_format in self.time_formats:
+        last_conversion = self.last_conversion
+        if last_conversion is not None and last_conversion[0] == arg:
+            return [last_conversion[1]]
+        compiled = self.compile_formats()
+        if compiled is None:
+            candidates = xrange(len(self.time_formats))
+        else:
+            regex, format_regexes = compiled
+            match = regex.match(arg)
+            first = len(self.time_formats)
+            if match is not None:
+                first = int(match.lastgroup[1:])
+            candidates = (i for i in xrange(first, len(self.time_formats))
+                          if format_regexes[i].match(arg) is not None)
+        for i in candidates:
             try:
-                return [time.strptime(arg, time_format)]
+                result = time.strptime(arg, self.time_formats[i])
             except ValueError:
-                pass
+                continue
+            self.last_conversion = (arg, result)
+            return [result]
         raise ValueError("no matching strptime() formats")
 
 
@@ -144,7 +265,7 @@ class DateSubtree(cmdparser.Subtree):
             return [datetime.date(tm.tm_year, tm.tm_mon, tm.tm_mday)]
 
         # All remaining formats are relative to the current date.
-        today = datetime.date.today()
+        today = get_today(context)
 
         # ( yesterday | today | tomorrow )
         for offset, name in enumerate(("yesterday", "today", "tomorrow"), -1):
@@ -211,7 +332,7 @@ class TimeSubtree(cmdparser.Subtree):
     def convert(self, args, fields, context):
 
         if "now" in fields:
-            tm = time.localtime()
+            tm = get_now(context).timetuple()
         else:
             tm = fields["<time>"][0]
         ret = datetime.time(tm.tm_hour, tm.tm_min, tm.tm_sec)
@@ -462,7 +583,7 @@ class DateTimeSubtree(cmdparser.Subtree):
 
     This subtree attempts to parse specifications of a date and time, either
     absolute or relative to the current time (as returned by
-    :meth:`datetime.datetime.now()`). The converted value is a
+    :func:`get_now()`). The converted value is a
     :class:`~datetime.datetime` instance.
     """
 
@@ -495,11 +616,11 @@ class DateTimeSubtree(cmdparser.Subtree):
             if "<date>" in fields:
                 d = fields["<date>"][0]
             else:
-                d = datetime.date.today()
+                d = get_today(context)
             return [datetime.datetime(d.year, d.month, d.day,
                                       t.hour, t.minute, t.second)]
         elif "<relative>" in fields:
-            return [datetime.datetime.now() + fields["<relative>"][0]]
+            return [get_now(context) + fields["<relative>"][0]]
         raise ValueError("invalid subtree syntax")
 
 
@@ -567,7 +688,7 @@ class PastCalendarPeriodSubtree(cmdparser.Subtree):
 
         # (last|this) (week|month|year)
         if args[0] in ("last", "this"):
-            today = datetime.date.today()
+            today = get_today(context)
             offset = -1 if args[0] == "last" else 0
             if args[1] == "week":
                 monday = (today + datetime.timedelta(offset * 7)
@@ -582,7 +703,7 @@ class PastCalendarPeriodSubtree(cmdparser.Subtree):
 
         # <n> (day|days|week|weeks|month|months|year|years) <ago>
         if "<n>" in fields:
-            today = datetime.date.today()
+            today = get_today(context)
             if args[1].startswith("day"):
                 start = today - datetime.timedelta(fields["<n>"][0])
                 return [(start, start + datetime.timedelta(1))]
@@ -618,7 +739,7 @@ class PastCalendarPeriodSubtree(cmdparser.Subtree):
             if "<year>" in fields:
                 year = fields["<year>"][0].tm_year
             else:
-                year = datetime.date.today().year
+                year = get_today(context).year
                 if "last" in fields:
                     year -= 1
             start = datetime.date(year, month, 1)
@@ -639,9 +760,66 @@ class PastCalendarPeriodSubtree(cmdparser.Subtree):
 
         # after <start>
         if "<start>" in fields:
-            return [(fields["<start>"][0], datetime.date.today())]
+            return [(fields["<start>"][0], get_today(context))]
 
         # This indicates a programming error, as the syntax checking should
         # have caught any syntactically invalid command strings.
         raise ValueError("unknown period syntax")
 
+
+
+
+# Subtree classes used by parse_many() for each kind of phrase.
+PARSE_KINDS = {
+    "date": DateSubtree,
+    "time": TimeSubtree,
+    "datetime": DateTimeSubtree,
+    "duration": DurationSubtree,
+    "period": PastCalendarPeriodSubtree,
+}
+
+# Maximum number of distinct phrases cached by parse_many().
+PARSE_CACHE_SIZE = 10000
+
+
+
+def parse_many(kind, strings, now=None):
+    """Convert many phrases of the same kind, such as when importing data.
+
+    The ``kind`` is one of the keys of :data:`PARSE_KINDS`, which selects
+    the subtree used to match each of ``strings`` after splitting them on
+    whitespace. A list is returned with the converted value of each string,
+    or ``None`` for any which don't match - use the subtree's
+    :meth:`~cmdparser.ParseItem.check_match()` to obtain an error message.
+
+    Relative phrases such as ``yesterday`` are all interpreted relative to
+    ``now`` (a :class:`~datetime.datetime`), which defaults to the time of
+    the call, so results are consistent however long the batch takes.
+    Repeated phrases are only matched once.
+    """
+
+    subtree_class = PARSE_KINDS.get(kind, None)
+    if subtree_class is None:
+        raise ValueError("unknown kind of phrase: %r" % (kind,))
+    tree = subtree_class(kind)
+    name = str(tree)
+    if now is None:
+        now = datetime.datetime.now()
+    context = FixedTimeContext(now)
+    cache = {}
+    results = []
+    for string in strings:
+        items = tuple(string.split())
+        if items in cache:
+            results.append(cache[items])
+            continue
+        fields = {}
+        if tree.check_match(items, fields=fields, context=context) is None:
+            value = fields[name][0]
+        else:
+            value = None
+        if len(cache) >= PARSE_CACHE_SIZE:
+            cache.clear()
+        cache[items] = value
+        results.append(value)
+    return results
@@ -0,0 +1,238 @@
+#!/usr/bin/python
+"""Simple timing benchmarks for cmdparser.
+
+These aren't run as part of the unit tests. To run all benchmarks, or just
+those named on the command-line, run this from the parent directory with:
+
+    python -m test.benchmark [<name> ...]
+"""
+
+import cmd
+import sys
+import timeit
+import unittest
+
+from cmdparser import cmdparser
+from cmdparser import datetimeparse
+from test import test_datetimeparse
+
+
+REPEATS = 5
+
+
+
+def period_token_factory(token):
+    """Token factory for the commands of the startup benchmark."""
+
+    if token == "period":
+        return datetimeparse.PastCalendarPeriodSubtree(token)
+    elif token == "time":
+        return datetimeparse.DateTimeSubtree(token)
+    elif token == "duration":
+        return datetimeparse.DurationSubtree(token)
+    elif token == "text":
+        return cmdparser.AnyTokenString(token)
+    return None
+
+
+
+def make_cmd_class(check_specs):
+    """Defines a cmd.Cmd class of a similar size to a typical application."""
+
+    dec = cmdparser.CmdMethodDecorator
+
+    class BenchmarkCmd(cmd.Cmd):
+
+        @dec(token_factory=period_token_factory)
+        def do_summary(self, args, fields):
+            """summary [tasks | tags] [<period>]"""
+
+        @dec(token_factory=period_token_factory)
+        def do_start(self, args, fields):
+            """start <text> [ ( at <time> | <duration> ago ) ]"""
+
+        @dec(token_factory=period_token_factory)
+        def do_stop(self, args, fields):
+            """stop [ ( at <time> | <duration> ago ) ]"""
+
+        @dec(token_factory=period_token_factory)
+        def do_switch(self, args, fields):
+            """switch <text> [ ( at <time> | <duration> ago ) ]"""
+
+        @dec(token_factory=period_token_factory)
+        def do_diary(self, args, fields):
+            """diary [<period>]"""
+
+        @dec(token_factory=period_token_factory)
+        def do_entry(self, args, fields):
+            """entry <text> from <time> ( to <time> | for <duration> )"""
+
+        @dec(token_factory=period_token_factory)
+        def do_status(self, args, fields):
+            """status"""
+
+    return cmdparser.CmdClassDecorator(check_specs=check_specs)(BenchmarkCmd)
+
+
+
+def bench_startup():
+    """Time to define a command class, and to dispatch a first command."""
+
+    def define_and_dispatch(check_specs):
+        make_cmd_class(check_specs)().do_summary("last week")
+
+    results = []
+    for label, check_specs in (("lazy", False), ("eager", True)):
+        timer = timeit.Timer(lambda c=check_specs: make_cmd_class(c))
+        results.append(("define (%s)" % (label,), timer, 10))
+        timer = timeit.Timer(lambda c=check_specs: define_and_dispatch(c))
+        results.append(("define and dispatch (%s)" % (label,), timer, 10))
+    return results
+
+
+
+def bench_subtrees():
+    """Time to construct the datetimeparse subtrees, with and without cache."""
+
+    def construct():
+        datetimeparse.PastCalendarPeriodSubtree("period")
+        datetimeparse.DateTimeSubtree("time")
+        datetimeparse.DurationSubtree("duration")
+
+    def construct_uncached():
+        cmdparser.Subtree._tree_cache.clear()
+        construct()
+
+    return [("construct (cached)", timeit.Timer(construct), 100),
+            ("construct (uncached)", timeit.Timer(construct_uncached), 10)]
+
+
+
+def bench_matching():
+    """Time to match and complete typical phrases with datetimeparse."""
+
+    period = datetimeparse.PastCalendarPeriodSubtree("period")
+    duration = datetimeparse.DurationSubtree("duration")
+    phrases = ((period, "last week"), (period, "week of 2013-03-04"),
+               (period, "between 2013-01-01 and 2013-02-01"),
+               (period, "not a period"),
+               (duration, "3 hours and 20 minutes"),
+               (duration, "1 year, 2 months, 3 weeks and 4 days"))
+    results = []
+    for tree, phrase in phrases:
+        items = phrase.split()
+        timer = timeit.Timer(lambda t=tree, i=items: t.check_match(i))
+        results.append(("match %r" % (phrase,), timer, 100))
+    for tree, phrase in ((period, "week of"), (duration, "3 hours and")):
+        items = phrase.split()
+        timer = timeit.Timer(lambda t=tree, i=items: t.get_completions(i))
+        results.append(("complete %r" % (phrase,), timer, 100))
+    return results
+
+
+
+def bench_packrat():
+    """Time to match adversarial duration phrases, with and without memo.
+
+    Each repeat of the outer alternation tries the duration subtree, which
+    matches the rest of the phrase before failing on "never", and then falls
+    back to matching a single item. Without the memo table this re-parses
+    the remainder of the phrase from every item, so time is quadratic in the
+    phrase length - with it, time should be roughly linear. The phrases used
+    with the memo table are much longer so that any quadratic behaviour
+    remaining is obvious.
+    """
+
+    def token_factory(token):
+        if token == "duration":
+            return datetimeparse.DurationSubtree(token)
+        return None
+
+    spec = "( <duration> never | <word> ) [...]"
+    tree = cmdparser.parse_spec(spec, ident_factory=token_factory)
+    results = []
+    for memoize, sizes in ((False, (8, 16, 32, 64)),
+                           (True, (64, 512, 1024, 2048))):
+        for repeats in sizes:
+            items = ("1 hour and " * repeats).split()
+            timer = timeit.Timer(lambda i=items, m=memoize:
+                                 tree.check_match(i, memoize=m))
+            label = "%d items (%s)" % (len(items),
+                                       "memo" if memoize else "no memo")
+            results.append((label, timer, 1))
+    return results
+
+
+
+def bench_strptime():
+    """Time to match strptime tokens, and to run datetimeparse tests."""
+
+    date = datetimeparse.StrptimeToken("date", ("%Y-%m-%d", "%d-%m-%Y"))
+    clock = datetimeparse.StrptimeToken("time", ("%I:%M:%S%p", "%H:%M:%S",
+                                                 "%I:%M%p", "%H:%M"))
+    results = []
+    for token, arg in ((date, "2013-03-04"), (date, "4/3/2013"),
+                       (date, "yesterday"), (clock, "10:30:15pm"),
+                       (clock, "22.30"), (clock, "noon")):
+        timer = timeit.Timer(lambda t=token, a=arg: t.check_match((a,)))
+        results.append(("match %r" % (arg,), timer, 1000))
+    # The duration tests are excluded as they don't use strptime tokens and
+    # would dominate the timings.
+    suite = unittest.TestSuite()
+    for case in (test_datetimeparse.TestStrptimeToken,
+                 test_datetimeparse.TestDateSubtree,
+                 test_datetimeparse.TestTimeSubtree,
+                 test_datetimeparse.TestDateTimeSubtree,
+                 test_datetimeparse.TestPastCalendarPeriodSubtree):
+        suite.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(case))
+    timer = timeit.Timer(lambda: suite.run(unittest.TestResult()))
+    results.append(("datetimeparse tests", timer, 1))
+    return results
+
+
+
+def bench_parse_many():
+    """Time to convert batches of phrases with datetimeparse.parse_many().
+
+    Half of the phrases in each batch are repeats, as is typical when
+    importing data.
+    """
+
+    times = ["%d:%02d" % (hour, minute) for hour in xrange(24)
+             for minute in xrange(60)]
+    phrases = [prefix + t for prefix in ("yesterday at ", "2013-03-04 at ")
+               for t in times]
+    phrases += ["%d hours ago" % (i,) for i in xrange(1, 1000)]
+    phrases.extend(phrases)
+    timer = timeit.Timer(lambda: datetimeparse.parse_many("datetime",
+                                                          phrases))
+    return [("%d datetime phrases" % (len(phrases),), timer, 1)]
+
+
+
+BENCHMARKS = (
+    ("startup", bench_startup),
+    ("subtrees", bench_subtrees),
+    ("matching", bench_matching),
+    ("packrat", bench_packrat),
+    ("strptime", bench_strptime),
+    ("parse_many", bench_parse_many),
+)
+
+
+
+def main(argv):
+    names = argv[1:]
+    for name, func in BENCHMARKS:
+        if names and name not in names:
+            continue
+        print "%s:" % (name,)
+        for label, timer, number in func():
+            best = min(timer.repeat(REPEATS, number)) / number
+            print "  %-40s %10.3f ms" % (label, best * 1000)
+    return 0
+
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
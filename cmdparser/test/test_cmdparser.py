@@ -1,5 +1,6 @@
 #!/usr/bin/python
 
+import cmd
 from cmdparser import cmdparser
 import unittest
 
@@ -84,12 +85,16 @@ class TestParser(unittest.TestCase):
         class XYZIdent(cmdparser.Token):
             def get_values(self, context):
                 return ["x", "y", "z"]
+        idents = []
         def ident_factory(ident):
+            idents.append(ident)
             if ident == "three":
                 return XYZIdent(ident)
             return None
         spec = "one <two> <three> <four...>"
         tree = cmdparser.parse_spec(spec, ident_factory=ident_factory)
+        # Identifiers matching remaining items aren't passed to the factory.
+        self.assertEqual(idents, ["two", "three"])
         self.assertIsInstance(tree, cmdparser.Sequence)
         self.assertEqual(len(tree.items), 4)
         self.assertIsInstance(tree.items[0], cmdparser.Token)
@@ -143,6 +148,20 @@ class TestParser(unittest.TestCase):
         self.assertIsInstance(tree.items[3], cmdparser.AnyTokenString)
 
 
+    def test_parse_subtree_shared(self):
+        def ident_factory(ident):
+            return None
+        sub1 = cmdparser.Subtree("sub1", "x (y|z)", ident_factory)
+        sub2 = cmdparser.Subtree("sub2", "x (y|z)", ident_factory)
+        sub3 = cmdparser.Subtree("sub3", "x (y|z)")
+        sub4 = cmdparser.Subtree("sub4", "x [y|z]", ident_factory)
+        self.assertTrue(sub1.parse_tree is sub2.parse_tree)
+        self.assertFalse(sub1.parse_tree is sub3.parse_tree)
+        self.assertFalse(sub1.parse_tree is sub4.parse_tree)
+        self.assertEqual(str(sub1), "<sub1>")
+        self.assertEqual(str(sub2), "<sub2>")
+
+
 
 class TestMatching(unittest.TestCase):
 
@@ -180,6 +199,47 @@ class TestMatching(unittest.TestCase):
         self.assertRegexpMatches(tree.check_match([]), "insufficient args")
 
 
+    def test_match_alternation_dispatch(self):
+        class XYZIdent(cmdparser.Token):
+            def get_values(self, context):
+                return ["x", "y", "z"]
+        def ident_factory(ident):
+            if ident == "xyz":
+                return XYZIdent(ident)
+            return None
+        spec = "(one two | (three | four) five | <xyz> | one <six> | <any>)"
+        tree = cmdparser.parse_spec(spec, ident_factory=ident_factory)
+        alt = tree.items[0]
+        self.assertEqual(sorted(alt.dispatch.keys()),
+                         ["four", "one", "three"])
+        self.assertEqual(alt.dispatch["one"], (alt.options[0], alt.options[2],
+                                               alt.options[3], alt.options[4]))
+        self.assertEqual(alt.fallback, (alt.options[2], alt.options[4]))
+        fields = {}
+        self.assertEqual(tree.check_match(("one", "two"), fields=fields), None)
+        self.assertEqual(fields, {"one": ["one"], "two": ["two"]})
+        fields = {}
+        self.assertEqual(tree.check_match(("one", "seven"), fields=fields),
+                         None)
+        self.assertEqual(fields["<six>"], ["seven"])
+        fields = {}
+        self.assertEqual(tree.check_match(("four", "five"), fields=fields),
+                         None)
+        self.assertEqual(fields, {"four": ["four"], "five": ["five"]})
+        self.assertEqual(tree.check_match(("y",)), None)
+        self.assertEqual(tree.check_match(("five",)), None)
+        self.assertRegexpMatches(tree.check_match(("three", "six")),
+                                 "command invalid somewhere in")
+        spec = "(one two | three four | <xyz>) five"
+        tree = cmdparser.parse_spec(spec, ident_factory=ident_factory)
+        error = tree.check_match(("a", "five"))
+        self.assertEqual(sorted(error.split(" and ")),
+                         ["'a' doesn't match '<xyz>'", "'a' doesn't match 'one'",
+                          "'a' doesn't match 'three'"])
+        self.assertEqual(tree.get_completions(()),
+                         set(("one", "three", "x", "y", "z")))
+
+
     def test_match_repeat_token(self):
         spec = "one two [...] three"
         tree = cmdparser.parse_spec(spec)
@@ -337,6 +397,175 @@ class TestMatching(unittest.TestCase):
                          "insufficient args")
 
 
+    def test_match_memoize(self):
+        calls = []
+        class CountingIdent(cmdparser.AnyToken):
+            def validate(self, arg, context):
+                calls.append(arg)
+                return arg.isdigit()
+        def ident_factory(ident):
+            if ident == "num":
+                return CountingIdent(ident)
+            elif ident == "nums":
+                return cmdparser.Subtree(ident, "(<num> [and]) [...]",
+                                         ident_factory=ident_factory)
+            return None
+        spec = "( <nums> one | <nums> two | <nums> | <any> ) [...]"
+        tree = cmdparser.parse_spec(spec, ident_factory=ident_factory)
+        items = ("1 and 2 and 3 x " * 3).split()
+        results = []
+        for memoize in (False, True):
+            del calls[:]
+            fields = {}
+            results.append((tree.check_match(items, fields=fields,
+                                             memoize=memoize),
+                            fields, len(calls)))
+        self.assertEqual(results[0][:2], results[1][:2])
+        self.assertEqual(results[1][1]["<any>"], ["x", "x", "x"])
+        self.assertTrue(results[1][2] < results[0][2])
+        self.assertEqual(tree.check_match(items, memoize=True), results[1][0])
+        self.assertEqual(tree.get_completions(items[:-1], memoize=False),
+                         tree.get_completions(items[:-1], memoize=True))
+        self.assertEqual(tree.get_completions(("1",), memoize=True),
+                         set(("one", "two", "and")))
+
+
+    def test_match_legacy_override(self):
+        class PairIdent(cmdparser.ParseItem):
+            def __str__(self):
+                return "<pair>"
+            def match(self, compare_items, fields=None, completions=None,
+                      trace=None, context=None):
+                if len(compare_items) < 2 or compare_items[0] != "pair":
+                    raise cmdparser.MatchError("no pair")
+                if fields is not None:
+                    fields["<pair>"] = [compare_items[1]]
+                return compare_items[2:]
+        def ident_factory(ident):
+            if ident == "pair":
+                return PairIdent()
+            return None
+        tree = cmdparser.parse_spec("one ( <pair> | two ) three",
+                                    ident_factory=ident_factory)
+        fields = {}
+        self.assertEqual(tree.check_match(("one", "pair", "x", "three"),
+                                          fields=fields), None)
+        self.assertEqual(fields["<pair>"], ["x"])
+        self.assertEqual(tree.check_match(("one", "two", "three")), None)
+        self.assertRegexpMatches(tree.check_match(("one", "four", "three")),
+                                 "no pair")
+        self.assertEqual(tree.match(["one", "two", "three", "four"]),
+                         ["four"])
+        self.assertRaises(cmdparser.MatchError, tree.match, ["one", "four"])
+        self.assertRaises(cmdparser.MatchError,
+                          cmdparser.ParseItem().match, ["one"])
+
+
+    def test_match_legacy_override_derived(self):
+        calls = []
+        def legacy_match(base, reject, message):
+            def match(self, compare_items, fields=None, completions=None,
+                      trace=None, context=None):
+                calls.append(str(self))
+                if compare_items and reject(compare_items[0]):
+                    raise cmdparser.MatchError(message)
+                return base.match(self, compare_items, fields=fields,
+                                  completions=completions, trace=trace,
+                                  context=context)
+            return match
+        class LowerToken(cmdparser.Token):
+            match = legacy_match(cmdparser.Token, str.isupper, "not upper")
+            def get_values(self, context):
+                return ["abc", "ABC"]
+        class ArgToken(cmdparser.AnyToken):
+            match = legacy_match(cmdparser.AnyToken,
+                                 lambda arg: arg.startswith("-"), "no options")
+        class NoXSubtree(cmdparser.Subtree):
+            match = legacy_match(cmdparser.Subtree, lambda arg: arg == "x",
+                                 "no x")
+        def ident_factory(ident):
+            if ident == "lower":
+                return LowerToken(ident)
+            elif ident == "arg":
+                return ArgToken(ident)
+            elif ident == "sub":
+                return NoXSubtree(ident, "(x|y) z")
+            return None
+        tree = cmdparser.parse_spec("<lower> <arg> <sub>",
+                                    ident_factory=ident_factory)
+        for memoize in (False, True):
+            del calls[:]
+            fields = {}
+            self.assertEqual(tree.check_match(("abc", "foo", "y", "z"),
+                                              fields=fields, memoize=memoize),
+                             None)
+            self.assertEqual(fields, {"<lower>": ["abc"], "<arg>": ["foo"],
+                                      "<sub>": ["y", "z"]})
+            self.assertEqual(calls, ["<lower>", "<arg>", "<sub>"])
+            self.assertEqual(tree.check_match(("ABC", "foo", "y", "z"),
+                                              memoize=memoize), "not upper")
+            self.assertEqual(tree.check_match(("abc", "-f", "y", "z"),
+                                              memoize=memoize), "no options")
+            self.assertEqual(tree.check_match(("abc", "foo", "x", "z"),
+                                              memoize=memoize), "no x")
+
+
+    def test_match_lazy_errors(self):
+        formatted = []
+        class CountingToken(cmdparser.Token):
+            def __str__(self):
+                formatted.append(self.name)
+                return self.name
+        def ident_factory(ident):
+            return CountingToken(ident)
+        tree = cmdparser.parse_spec("<one> [<two>|<three>] <four>",
+                                    ident_factory=ident_factory)
+        self.assertEqual(tree.check_match(("one", "three", "four")), None)
+        self.assertEqual(tree.get_completions(("one", "two")),
+                         set(("four",)))
+        self.assertEqual(formatted, [])
+        self.assertEqual(tree.check_match(("one", "five")),
+                         "'five' doesn't match 'four'")
+        self.assertEqual(formatted, ["four"])
+
+
+    def test_match_cached_token(self):
+        loads = []
+        class Context(object):
+            version = 1
+            names = ["one", "two"]
+            def get_data_version(self):
+                return self.version
+        class NameToken(cmdparser.CachedToken):
+            def load_values(self, context):
+                loads.append(self.name)
+                return context.names
+        token = NameToken("name")
+        def ident_factory(ident):
+            return token
+        tree = cmdparser.parse_spec("<name> [...]",
+                                    ident_factory=ident_factory)
+        context = Context()
+        self.assertEqual(tree.check_match(("one", "two", "one"),
+                                          context=context), None)
+        self.assertEqual(loads, ["name"])
+        context.names = ["three"]
+        self.assertNotEqual(tree.check_match(("three",), context=context),
+                            None)
+        context.version = 2
+        self.assertEqual(tree.check_match(("three",), context=context), None)
+        self.assertEqual(loads, ["name", "name"])
+        token.invalidate()
+        self.assertEqual(tree.check_match(("three",), context=context), None)
+        self.assertEqual(len(loads), 3)
+        del context
+        context = Context()
+        context.version = 2
+        self.assertNotEqual(tree.check_match(("three",), context=context),
+                            None)
+        self.assertEqual(len(loads), 4)
+
+
 
 class TestCompletions(unittest.TestCase):
 
@@ -452,6 +681,189 @@ class TestCompletions(unittest.TestCase):
         self.assertEqual(tree.get_completions(("one", "four", "six")), set())
 
 
+    def test_complete_prefix(self):
+        class Context(object):
+            def get_data_version(self):
+                return 1
+        class NameToken(cmdparser.CachedToken):
+            def load_values(self, context):
+                return ["alpha", "alps", "beta", "al"]
+        def ident_factory(ident):
+            return NameToken(ident)
+        tree = cmdparser.parse_spec("( <name> | alpine )",
+                                    ident_factory=ident_factory)
+        self.assertEqual(tree.get_completions((), prefix="alp"),
+                         set(("alpha", "alps", "alpine")))
+        self.assertEqual(tree.get_completions((), prefix="alp",
+                                              context=Context()),
+                         set(("alpha", "alps", "alpine")))
+        self.assertEqual(tree.get_completions((), prefix="z",
+                                              context=Context()), set())
+        index = cmdparser.PrefixIndex(["b", "ab", "a", "abc", "ac", "ab"])
+        self.assertEqual(index.get_prefixed("ab"), ["ab", "abc"])
+        self.assertEqual(index.get_prefixed(""), ["a", "ab", "abc", "ac", "b"])
+        self.assertEqual(index.get_prefixed("c"), [])
+
+
+    def test_complete_token_string(self):
+        class PhraseToken(cmdparser.AnyTokenString):
+            def complete_items(self, items, prefix, context):
+                phrases = (("hello", "world"), ("hello", "there"), ("hi",))
+                n = len(items)
+                return [i[n] for i in phrases if len(i) > n and
+                        tuple(items) == i[:n] and i[n].startswith(prefix)]
+        def ident_factory(ident):
+            if ident == "words":
+                return PhraseToken("words")
+            return None
+        tree = cmdparser.parse_spec("say <words>",
+                                    ident_factory=ident_factory)
+        self.assertEqual(tree.get_completions(("say",)), set(("hello", "hi")))
+        self.assertEqual(tree.get_completions(("say",), prefix="he"),
+                         set(("hello",)))
+        self.assertEqual(tree.get_completions(("say", "hello")),
+                         set(("world", "there")))
+        self.assertEqual(tree.get_completions(("say", "bye")), set())
+        fields = {}
+        self.assertEqual(tree.check_match(("say", "any", "thing"),
+                                          fields=fields), None)
+        self.assertEqual(fields["<words...>"], ["any", "thing"])
+
+
+
+class TestDecorators(unittest.TestCase):
+
+    def test_lazy_parse_tree(self):
+        @cmdparser.CmdClassDecorator()
+        class TestCmd(cmd.Cmd):
+            @cmdparser.CmdMethodDecorator()
+            def do_one(self, args, fields):
+                """one ( two | three )
+
+                Test command.
+                """
+                self.result = args
+            @cmdparser.CmdMethodDecorator()
+            def do_four(self, args, fields):
+                """five six
+
+                Invalid command.
+                """
+        dec = TestCmd.do_one._cmdparser_decorator
+        self.assertEqual(dec.spec, "one ( two | three )")
+        self.assertEqual(TestCmd.do_one.__doc__, "\none ( two | three )\n\n"
+                         "Test command.\n")
+        self.assertEqual(dec._parse_tree, None)
+        instance = TestCmd()
+        instance.do_one("three")
+        self.assertEqual(instance.result, ["one", "three"])
+        self.assertNotEqual(dec._parse_tree, None)
+        self.assertEqual(instance.complete_one("t", "one t", 4, 5),
+                         ["two", "three"])
+        self.assertRaisesRegexp(cmdparser.ParseError, "four: command spec",
+                                TestCmd.do_four._cmdparser_decorator.check_spec)
+        self.assertRaises(cmdparser.ParseError, cmdparser.check_cmd_specs,
+                          TestCmd)
+
+
+    def test_profile_cmd_line(self):
+        class XYZIdent(cmdparser.Token):
+            def get_values(self, context):
+                return ["x", "y", "z"]
+        def ident_factory(ident):
+            if ident == "xyz":
+                return XYZIdent(ident)
+            return None
+        class TestCmd(cmd.Cmd):
+            @cmdparser.CmdMethodDecorator(token_factory=ident_factory)
+            def do_one(self, args, fields):
+                """one ( two | <xyz> ) [...]"""
+        instance = TestCmd()
+        profile = cmdparser.profile_cmd_line(instance, "one x y two z")
+        nodes = dict((str(node.item), node) for node in profile.get_nodes())
+        self.assertEqual(nodes["<xyz>"].calls, 4)
+        self.assertEqual(nodes["<xyz>"].failures, 1)
+        self.assertEqual(nodes["<xyz>"].get_values, 3)
+        self.assertEqual(nodes["(two|<xyz>) [...]"].calls, 1)
+        self.assertEqual(nodes["(two|<xyz>) [...]"].failures, 0)
+        for node in profile.get_nodes():
+            self.assertTrue(node.total_time >= node.own_time >= 0.0)
+        self.assertEqual(profile.report(limit=3).count("\n"), 3)
+        self.assertRegexpMatches(profile.report(), "XYZIdent <xyz> +4 +1 +0 +3")
+        profile = cmdparser.profile_cmd_line(instance, "one x", complete=True)
+        nodes = dict((str(node.item), node) for node in profile.get_nodes())
+        self.assertEqual(nodes["<xyz>"].get_values, 2)
+        self.assertRaises(ValueError, cmdparser.profile_cmd_line, instance,
+                          "two")
+
+
+    def test_completion_cache(self):
+        calls = []
+        class XYZIdent(cmdparser.Token):
+            def get_values(self, context):
+                calls.append(context.version)
+                return ["xa", "xb", "y"]
+        def ident_factory(ident):
+            if ident == "xyz":
+                return XYZIdent(ident)
+            return None
+        @cmdparser.CmdClassDecorator()
+        class TestCmd(cmd.Cmd):
+            version = 1
+            def get_data_version(self):
+                return self.version
+            @cmdparser.CmdMethodDecorator(token_factory=ident_factory)
+            def do_one(self, args, fields):
+                """one <xyz> [...]"""
+        instance = TestCmd()
+        self.assertEqual(sorted(instance.complete_one("", "one ", 4, 4)),
+                         ["xa", "xb", "y"])
+        self.assertEqual(sorted(instance.complete_one("x", "one x", 4, 5)),
+                         ["xa", "xb"])
+        self.assertEqual(instance.complete_one("xb", "one xb", 4, 6), ["xb"])
+        self.assertEqual(sorted(instance.complete_one("", "one ", 4, 4)),
+                         ["xa", "xb", "y"])
+        self.assertEqual(calls, [1])
+        self.assertEqual(instance.complete_one("y", "one xa y", 7, 8), ["y"])
+        self.assertEqual(len(calls), 3)
+        instance.version = 2
+        self.assertEqual(instance.complete_one("y", "one xa y", 7, 8), ["y"])
+        self.assertEqual(calls[3:], [2, 2])
+        # A new context mustn't reuse the cache, even if it has the same
+        # data version and happens to get the same id().
+        del instance
+        instance = TestCmd()
+        instance.version = 2
+        self.assertEqual(instance.complete_one("y", "one xa y", 7, 8), ["y"])
+        self.assertEqual(calls[5:], [2, 2])
+
+
+    def test_syntax_error_hook(self):
+        class TestCmd(cmd.Cmd):
+            def syntax_error(self, error, parse_tree):
+                self.error = (error, str(parse_tree))
+                return "failed"
+            @cmdparser.CmdMethodDecorator()
+            def do_one(self, args, fields):
+                """one two"""
+                return "ok"
+        instance = TestCmd()
+        self.assertEqual(instance.do_one("two"), "ok")
+        self.assertEqual(instance.do_one("three"), "failed")
+        self.assertEqual(instance.error, ("'three' doesn't match 'two'",
+                                          "one two"))
+
+
+    def test_check_specs(self):
+        class TestCmd(cmd.Cmd):
+            @cmdparser.CmdMethodDecorator()
+            def do_one(self, args, fields):
+                """( one | two )"""
+        self.assertRaisesRegexp(cmdparser.ParseError, "unique initial token",
+                                cmdparser.CmdClassDecorator(check_specs=True),
+                                TestCmd)
+
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -67,6 +67,42 @@ class TestStrptimeToken(unittest.TestCase):
         self.assertRegexpMatches(tree.check_match(("Augu",)), "not a valid")
 
 
+    def test_strptime_compiled_formats(self):
+        tree = datetimeparse.StrptimeToken("x", ("%d-%m-%Y", "%H:%M"))
+        calls = []
+        old_strptime = time.strptime
+        def my_strptime(*args):
+            calls.append(args)
+            return old_strptime(*args)
+        time.strptime = my_strptime
+        try:
+            self.assertRegexpMatches(tree.check_match(("tuesday",)),
+                                     "not a valid")
+            self.assertRegexpMatches(tree.check_match(("31/02/2013",)),
+                                     "not a valid")
+            fields = {}
+            self.assertEqual(tree.check_match(("10.30",), fields=fields), None)
+        finally:
+            time.strptime = old_strptime
+        self.assertEqual(fields, {"<x>": [time.strptime("10:30", "%H:%M")]})
+        self.assertEqual(calls, [("31/02/2013", "%d/%m/%Y"),
+                                 ("10.30", "%H.%M")])
+
+
+    def test_strptime_uncompiled_formats(self):
+        old_time_re = datetimeparse.TimeRE
+        datetimeparse.TimeRE = None
+        try:
+            tree = datetimeparse.StrptimeToken("x", ("%d-%m-%Y", "%H:%M"))
+            self.assertRegexpMatches(tree.check_match(("tuesday",)),
+                                     "not a valid")
+            fields = {}
+            self.assertEqual(tree.check_match(("10.30",), fields=fields), None)
+        finally:
+            datetimeparse.TimeRE = old_time_re
+        self.assertEqual(fields, {"<x>": [time.strptime("10:30", "%H:%M")]})
+
+
 
 class TestDateSubtree(unittest.TestCase):
 
@@ -589,6 +625,37 @@ class TestPastCalendarPeriodSubtree(unittest.TestCase):
 
 
 
+class TestParseMany(unittest.TestCase):
+
+    def test_parse_datetimes(self):
+        # 6th June 2012 is a Wednesday
+        now = datetime.datetime(2012, 6, 6, 12, 30)
+        with fake_now(2013, 1, 1):
+            results = datetimeparse.parse_many("datetime",
+                                               ("yesterday at 9:15",
+                                                "3 hours ago", "now",
+                                                "not a time",
+                                                " yesterday  at 9:15"),
+                                               now=now)
+        self.assertEqual(results, [datetime.datetime(2012, 6, 5, 9, 15),
+                                   datetime.datetime(2012, 6, 6, 9, 30),
+                                   now, None,
+                                   datetime.datetime(2012, 6, 5, 9, 15)])
+        self.assertTrue(results[0] is results[4])
+
+
+    def test_parse_periods(self):
+        now = datetime.datetime(2012, 6, 6, 12, 30)
+        results = datetimeparse.parse_many("period", ("week of 2014-03-03",
+                                                      "last week"), now=now)
+        self.assertEqual(results, [(datetime.date(2014, 3, 3),
+                                    datetime.date(2014, 3, 10)),
+                                   (datetime.date(2012, 5, 28),
+                                    datetime.date(2012, 6, 4))])
+        self.assertRaises(ValueError, datetimeparse.parse_many, "foo", ())
+
+
+
 if __name__ == "__main__":
     unittest.main()
 
@@ -3,14 +3,24 @@ import bisect
 import cPickle
 import collections
 from datetime import datetime, timedelta
+import mmap
 import os
+import re
 import sqlite3
+import struct
+import sys
 import time
+import urllib
 
 
 __version__ = "1.1.1.dev2"
 
 MAX_SQLITE_VARS = 999
+HEARTBEAT_FORMAT = struct.Struct("!Q")
+# Splits a search query into quoted phrases and other words.
+SEARCH_TERM_RE = re.compile(r'"[^"]*"|[^\s"]+')
+# Search operators supported by each full-text search module.
+SEARCH_OPERATORS = {"fts5": ("OR", "NOT"), "fts4": ("OR",), None: ()}
 
 
 
@@ -19,6 +29,111 @@ class TimeTrackError(Exception):
 
 
 
+class TrackConnection(sqlite3.Connection):
+    """SQLite connection whose transactions may enclose one another.
+
+    The standard connection commits at the end of every ``with conn:``
+    block, so a sequence of calls which each use one can't be made atomic.
+    Instead, this class should be opened with ``isolation_level=None`` and
+    issues BEGIN only when the outermost block is entered and COMMIT, or
+    ROLLBACK if an exception was raised, only when it's left. Inner blocks
+    use savepoints, so an exception leaving one only rolls back the changes
+    made within it. Statements executed outside of any block are committed
+    immediately. If the final COMMIT fails, for example because another
+    process holds a lock, the transaction is rolled back before the error
+    is raised so the connection can still be used.
+    """
+
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.depth = 0
+        self.begin_sql = "BEGIN"
+
+
+    def immediate(self):
+        """Returns the connection for a block which locks out other writers.
+
+        If the block is the outermost, it begins with BEGIN IMMEDIATE so
+        the write lock is taken on entry rather than at the first write, and
+        anything read within the block can't be changed by another process
+        before the block's own changes are made.
+        """
+
+        self.begin_sql = "BEGIN IMMEDIATE"
+        return self
+
+
+    def __enter__(self):
+        begin_sql, self.begin_sql = self.begin_sql, "BEGIN"
+        if self.depth == 0:
+            self.execute(begin_sql)
+        else:
+            self.execute("SAVEPOINT nested_%d" % (self.depth,))
+        self.depth += 1
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if self.depth == 0:
+            if exc_type is None:
+                try:
+                    self.execute("COMMIT")
+                except sqlite3.Error:
+                    exc_info = sys.exc_info()
+                    try:
+                        self.execute("ROLLBACK")
+                    except sqlite3.Error:
+                        pass
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            else:
+                self.execute("ROLLBACK")
+        else:
+            savepoint = "nested_%d" % (self.depth,)
+            if exc_type is not None:
+                self.execute("ROLLBACK TO " + savepoint)
+            self.execute("RELEASE " + savepoint)
+        return False
+
+
+
+def get_read_only_uri(filename):
+    """Returns a URI which opens an existing database file read-only.
+
+    Python 2's sqlite3 module only accepts URIs if SQLite was built to treat
+    filenames as URIs by default, so None is returned if it wasn't, or if
+    the file doesn't exist yet.
+    """
+
+    if filename == ":memory:" or not os.path.isfile(filename):
+        return None
+    conn = sqlite3.connect(":memory:")
+    try:
+        options = set(row[0] for row in conn.execute("PRAGMA compile_options"))
+    finally:
+        conn.close()
+    if "USE_URI" not in options:
+        return None
+    return "file:%s?mode=ro" % (urllib.quote(os.path.abspath(filename)),)
+
+
+
+def get_prefix_bound(prefix):
+    """Returns lowest string greater than every string starting with prefix.
+
+    Returns None if there is no such string (e.g. an empty prefix).
+    """
+    if isinstance(prefix, unicode):
+        char_func, max_char = unichr, unichr(sys.maxunicode)
+    else:
+        char_func, max_char = chr, "\xff"
+    prefix = prefix.rstrip(max_char)
+    if not prefix:
+        return None
+    return prefix[:-1] + char_func(ord(prefix[-1]) + 1)
+
+
+
 class TiedContainer(object):
     """Mixin class to add shared methods for tied containers."""
 
@@ -48,6 +163,23 @@ class TiedContainer(object):
             return False
 
 
+    def get_prefixed(self, prefix):
+        """Returns sorted list of names which start with prefix.
+
+        This uses a range query on the index of names, so the cost depends
+        on the number of matches rather than the size of the table.
+        """
+        cur = self.conn.cursor()
+        bound = get_prefix_bound(prefix)
+        if bound is None:
+            cur.execute("SELECT name FROM %s WHERE name >= ? ORDER BY name"
+                        % (self.table,), (prefix,))
+        else:
+            cur.execute("SELECT name FROM %s WHERE name >= ? AND name < ?"
+                        " ORDER BY name" % (self.table,), (prefix, bound))
+        return [row[0] for row in cur]
+
+
     def get_id(self, item):
         cur = self.conn.cursor()
         cur.execute("SELECT id FROM %s WHERE name LIKE ?" % (self.table,),
@@ -100,6 +232,18 @@ class TiedDict(TiedContainer, collections.MutableMapping):
                         % (self.table,), (item, cPickle.dumps(value)))
 
 
+    def update(self, *args, **kwargs):
+        """As dict.update(), but all items are set by a single statement."""
+
+        items = dict(*args, **kwargs)
+        cur = self.conn.cursor()
+        with self.conn:
+            cur.executemany("INSERT OR REPLACE INTO %s (name, value)"
+                            " VALUES (?, ?)" % (self.table,),
+                            ((item, cPickle.dumps(value))
+                             for item, value in items.iteritems()))
+
+
     def __delitem__(self, item):
         cur = self.conn.cursor()
         with self.conn:
@@ -152,6 +296,116 @@ class TiedSet(TiedContainer, collections.MutableSet):
 
 
 
+def create_search_index(cur, table, modules=("fts5", "fts4"), index=None,
+                        tokenize=None):
+    """Creates a full-text index of the description column of a table.
+
+    The first of modules which SQLite supports is used, by default FTS5 or
+    otherwise FTS4. The index refers to the table's own rows rather than
+    storing another copy of the text, and is kept up to date by triggers.
+    Any rows already in the table are indexed when it's created. The index
+    is named after the table unless index is given, and tokenize selects
+    an FTS5 tokenizer other than the default. Returns False if none of the
+    modules (or the tokenizer) are available.
+    """
+
+    if index is None:
+        index = table + "_fts"
+    for module in modules:
+        if module == "fts5":
+            options = "" if tokenize is None else ", tokenize='%s'" % tokenize
+            create_sql = ("CREATE VIRTUAL TABLE %s USING fts5(description,"
+                          " content='%s', content_rowid='id'%s)"
+                          % (index, table, options))
+            delete_sql = ("INSERT INTO %s (%s, rowid, description)"
+                          " VALUES ('delete', old.id, old.description)"
+                          % (index, index))
+        else:
+            create_sql = ("CREATE VIRTUAL TABLE %s USING %s(description,"
+                          " content='%s')" % (index, module, table))
+            delete_sql = "DELETE FROM %s WHERE rowid=old.id" % (index,)
+        try:
+            cur.execute(create_sql)
+            break
+        except sqlite3.OperationalError:
+            pass
+    else:
+        return False
+    insert_sql = ("INSERT INTO %s (rowid, description)"
+                  " VALUES (new.id, new.description)" % (index,))
+
+    # Old values must be removed before the row changes, as FTS4 reads them
+    # back from the table.
+    for name, when, sql in (("insert", "AFTER INSERT", insert_sql),
+                            ("delete", "BEFORE DELETE", delete_sql),
+                            ("unindex", "BEFORE UPDATE OF description",
+                             delete_sql),
+                            ("reindex", "AFTER UPDATE OF description",
+                             insert_sql)):
+        cur.execute("CREATE TRIGGER %s_%s %s ON %s BEGIN %s; END"
+                    % (index, name, when, table, sql))
+    cur.execute("INSERT INTO %s (%s) VALUES ('rebuild')" % (index, index))
+    return True
+
+
+
+def create_recency_table(cur):
+    """Creates the task_recency table summarising each task's use.
+
+    This holds one row per task which has log entries, recording the ID,
+    start and end of its most recent entry and the number of entries. It's
+    kept up to date by triggers on tasklog, so it remains correct however
+    entries are added, edited or removed, and it's populated from any
+    existing entries when it's created.
+    """
+
+    cur.execute("CREATE TABLE task_recency ("
+                " task INTEGER PRIMARY KEY,"
+                " last_entry INTEGER,"
+                " last_start INTEGER,"
+                " last_end INTEGER,"
+                " uses INTEGER NOT NULL,"
+                " FOREIGN KEY (task) REFERENCES tasks(id))")
+    cur.execute("CREATE INDEX task_recency_start ON task_recency (last_start)")
+    cur.execute("CREATE INDEX task_recency_end ON task_recency (last_end)")
+
+    # Finding a task's latest entry is an index search on tasklog_task.
+    # Its times are then copied, so these must be run in this order.
+    refresh_entry_sql = ("UPDATE task_recency SET last_entry=(SELECT id"
+                         " FROM tasklog WHERE task=%(task)s"
+                         " ORDER BY start DESC, id DESC LIMIT 1)"
+                         " WHERE %(where)s")
+    refresh_times_sql = ("UPDATE task_recency SET"
+                         " last_start=(SELECT start FROM tasklog"
+                         " WHERE id=last_entry),"
+                         " last_end=(SELECT end FROM tasklog"
+                         " WHERE id=last_entry) WHERE %(where)s")
+    refresh_statements = (refresh_entry_sql, refresh_times_sql)
+    refresh = lambda task: " ".join(i % {"task": task, "where": "task=" + task}
+                                    + ";" for i in refresh_statements)
+    add_use = ("INSERT OR IGNORE INTO task_recency (task, uses)"
+               " VALUES (new.task, 0);"
+               " UPDATE task_recency SET uses=uses+1 WHERE task=new.task;")
+    remove_use = "UPDATE task_recency SET uses=uses-1 WHERE task=old.task;"
+    cur.execute("CREATE TRIGGER task_recency_insert AFTER INSERT ON tasklog"
+                " BEGIN %s %s END" % (add_use, refresh("new.task")))
+    cur.execute("CREATE TRIGGER task_recency_update"
+                " AFTER UPDATE OF task, start, end ON tasklog"
+                " BEGIN %s %s %s %s END" % (remove_use, add_use,
+                                            refresh("old.task"),
+                                            refresh("new.task")))
+    cur.execute("CREATE TRIGGER task_recency_delete AFTER DELETE ON tasklog"
+                " BEGIN %s %s END" % (remove_use, refresh("old.task")))
+    cur.execute("CREATE TRIGGER task_recency_forget AFTER DELETE ON tasks"
+                " BEGIN DELETE FROM task_recency WHERE task=old.id; END")
+
+    cur.execute("INSERT INTO task_recency (task, uses)"
+                " SELECT task, COUNT(*) FROM tasklog GROUP BY task")
+    for statement in refresh_statements:
+        cur.execute(statement % {"task": "task_recency.task", "where": "1"})
+
+
+
 def create_tracklib_schema(logger, conn):
 
     cur = conn.cursor()
@@ -218,6 +472,30 @@ def create_tracklib_schema(logger, conn):
                         " value TEXT)")
             cur.execute("INSERT INTO info (name, value) VALUES (?, ?)",
                         ("version", cPickle.dumps(1)))
+        # Entries are listed in order of start time, often only a page at
+        # a time, so this index avoids sorting the whole log for each query.
+        cur.execute("CREATE INDEX IF NOT EXISTS tasklog_start"
+                    " ON tasklog (start)")
+        cur.execute("CREATE INDEX IF NOT EXISTS tasklog_task"
+                    " ON tasklog (task, start)")
+        cur.execute("CREATE INDEX IF NOT EXISTS tasklog_end"
+                    " ON tasklog (end)")
+        if "task_recency" not in tables:
+            create_recency_table(cur)
+        # Todos are looked up by task, and tasks by tag, so these avoid
+        # scanning every todo or tag mapping.
+        cur.execute("CREATE INDEX IF NOT EXISTS todos_task ON todos (task)")
+        cur.execute("CREATE INDEX IF NOT EXISTS tagmappings_tag"
+                    " ON tagmappings (tag)")
+        # Without FTS support, search_diary() falls back to a slower scan.
+        for table in ("diary", "todos"):
+            if table + "_fts" not in tables:
+                create_search_index(cur, table)
+        # Todos are matched by any substring of their description, which
+        # only a trigram index can answer - without it they're scanned.
+        if "todos_trigram" not in tables:
+            create_search_index(cur, "todos", modules=("fts5",),
+                                index="todos_trigram", tokenize="trigram")
 
 
 
@@ -230,6 +508,10 @@ class TaskLogEntry(object):
     is set to False, which makes start and end read-only. This is typically
     done for TaskLogEntry instances returned from get_task_log_entries()
     because the times may be truncated to fit the search range in that case.
+
+    The cursor attribute holds the entry's original start time, as a UTC
+    timestamp, and ID, which can be passed as the after parameter of
+    get_task_log_entries() to resume a query from this entry.
     """
 
     def __init__(self, logger, db, task, entry_id, start, end,
@@ -241,6 +523,7 @@ class TaskLogEntry(object):
         self.entry_id = entry_id
         self.db = db
         self.mutable_times = mutable_times
+        self.cursor = (int(start), entry_id)
         # Store IDs of associated diary and complete todo entries for delete().
         self._diary_ids = set()
         self._todo_ids = set()
@@ -388,25 +671,91 @@ class TaskLogEntry(object):
         """Permanently delete this entry."""
 
         cur = self.db.conn.cursor()
-        cur.execute("DELETE FROM tasklog WHERE id=?", (self.entry_id,))
-        self.mutable_times = False
-        if cur.rowcount < 1:
-            raise TimeTrackError("no such entry")
+        with self.db.conn:
+            cur.execute("DELETE FROM tasklog WHERE id=?", (self.entry_id,))
+            self.mutable_times = False
+            if cur.rowcount < 1:
+                raise TimeTrackError("no such entry")
+
+            # We explicitly don't copy ids here because as we delete IDs from
+            # the DB, it's correct to also remove them from our set. The code
+            # is a little fiddly to account for the fact that SQLite limits
+            # the number of variables to 999, so we have to remove them in
+            # blocks that big.
+            def delete_helper(table, ids):
+                while ids:
+                    removals = []
+                    while ids and len(removals) < MAX_SQLITE_VARS:
+                        removals.append(ids.pop())
+                    cur.execute("DELETE FROM " + table + " WHERE id IN (%s)" %
+                                (",".join("?" * len(removals)),), removals)
+
+            delete_helper("diary", self._diary_ids)
+            delete_helper("todos", self._todo_ids)
+
+
+
+def get_heartbeat_filename(filename):
+    """Returns the name of the heartbeat file for a database file."""
+
+    return filename + "-heartbeat"
+
+
+
+def read_heartbeat(filename):
+    """Returns the time in a heartbeat file as a local datetime, or None."""
+
+    try:
+        with open(filename, "rb") as heartbeat_fd:
+            data = heartbeat_fd.read(HEARTBEAT_FORMAT.size)
+    except IOError:
+        return None
+    if len(data) < HEARTBEAT_FORMAT.size:
+        return None
+    epoch_time = HEARTBEAT_FORMAT.unpack(data)[0]
+    return datetime.fromtimestamp(epoch_time) if epoch_time else None
+
+
+
+class HeartbeatUpdater(object):
+    """Handler to update last seen time in a heartbeat file.
+
+    This is an alternative to LastSeenUpdater which avoids committing a
+    transaction to the database on every update. Instead the time is stored
+    in a small file alongside the database which is memory-mapped, so each
+    update is simply a write to memory and the kernel writes the page back
+    to disk in its own time. This survives the application crashing, but
+    not necessarily the whole system doing so. TimeTrackDB reads the time
+    back when the database is next opened, and get_info_times() reads it
+    during a session. Call close() to unmap the file.
+    """
+
+    def __init__(self, db):
+        """Opens and maps heartbeat file, creating it if required."""
+
+        self.logger = db.logger
+        filename = get_heartbeat_filename(db.filename)
+        heartbeat_fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0666)
+        try:
+            if os.fstat(heartbeat_fd).st_size < HEARTBEAT_FORMAT.size:
+                os.ftruncate(heartbeat_fd, HEARTBEAT_FORMAT.size)
+            self.map = mmap.mmap(heartbeat_fd, HEARTBEAT_FORMAT.size)
+        finally:
+            os.close(heartbeat_fd)
+
+
+    def update(self):
+        """Updates time in heartbeat file."""
 
-        # We explicitly don't copy ids here because as we delete IDs from the
-        # DB, it's correct to also remove them from our set. The code is a
-        # little fiddly to account for the fact that SQLite limits the number
-        # of variables to 999, so we have to remove them in blocks that big.
-        def delete_helper(table, ids):
-            while ids:
-                removals = []
-                while ids and len(removals) < MAX_SQLITE_VARS:
-                    removals.append(ids.pop())
-                cur.execute("DELETE FROM " + table + " WHERE id IN (%s)" %
-                            (",".join("?" * len(removals)),), removals)
+        HEARTBEAT_FORMAT.pack_into(self.map, 0, int(time.time()))
 
-        delete_helper("diary", self._diary_ids)
-        delete_helper("todos", self._todo_ids)
+
+    def close(self):
+        """Unmaps heartbeat file, which also closes the descriptor."""
+
+        if self.map is not None:
+            self.map.close()
+            self.map = None
 
 
 
@@ -432,24 +781,77 @@ class LastSeenUpdater(object):
         self.info["lastseen_time"] = datetime.now()
 
 
+    def close(self):
+        """Closes database connection."""
+
+        self.conn.close()
+
+
 
 class TimeTrackDB(object):
 
-    def __init__(self, logger, filename=None):
-        """Opens database, creating it if required."""
+    def __init__(self, logger, filename=None, read_only=False, session=True,
+                 heartbeat=False):
+        """Opens database, creating it if required.
+
+        If read_only is True the database is opened read-only, and startup
+        and shutdown times aren't recorded, so that queries neither write to
+        it nor wait for another process which is. If that isn't possible,
+        because SQLite doesn't support URI filenames or the database doesn't
+        exist yet or its schema needs upgrading, it's opened as normal to
+        create the schema and then switched to query-only mode.
+
+        If session is False, startup and shutdown times aren't recorded
+        either - this is for connections which aren't an interactive
+        session, such as those held by server worker threads.
+
+        If heartbeat is True, a session on a database file also opens a
+        HeartbeatUpdater as the heartbeat attribute, so the last seen time
+        can be recorded without writing to the database. Otherwise, or if
+        the heartbeat file can't be used, the attribute is None.
+        """
 
         self.logger = logger
         if filename is None:
             filename = os.path.expanduser("~/.timetrackdb")
-        self.conn = sqlite3.connect(filename)
         self.filename = filename
-        self.ensure_schema()
+        self.current_state = None
+        self.current_state_version = None
+        self.conn = None
+        self.heartbeat = None
+        self.read_only = read_only
+        self.session = False
+        uri = get_read_only_uri(filename) if read_only else None
+        if uri is not None:
+            self.conn = sqlite3.connect(uri, isolation_level=None,
+                                        factory=TrackConnection)
+            try:
+                self.ensure_schema()
+            except sqlite3.OperationalError:
+                self.conn.close()
+                self.conn = None
+        if self.conn is None:
+            self.conn = sqlite3.connect(filename, isolation_level=None,
+                                        factory=TrackConnection)
+            self.ensure_schema()
+            if read_only:
+                self.conn.execute("PRAGMA query_only = 1")
         self.tags = TiedSet(logger, self.conn, "tag")
         self.tasks = TiedSet(logger, self.conn, "task")
         self.info = TiedDict(logger, self.conn, "info")
+        self.session = session and not self.read_only
+        if not self.session:
+            return
 
-        # Check if "last seen" is more recent than "shutdown", and update the
-        # latter if so.
+        # Take "last seen" from the heartbeat file if it's more recent than
+        # the database, then check if it's more recent than "shutdown" and
+        # update the latter if so.
+        if filename != ":memory:":
+            last_beat = read_heartbeat(get_heartbeat_filename(filename))
+            if last_beat is not None:
+                if ("lastseen_time" not in self.info or
+                    last_beat > self.info["lastseen_time"]):
+                    self.info["lastseen_time"] = last_beat
         if "lastseen_time" in self.info:
             if ("shutdown_time" not in self.info or
                 self.info["lastseen_time"] > self.info["shutdown_time"]):
@@ -457,13 +859,32 @@ class TimeTrackDB(object):
 
         # Log startup time and update "last seen".
         self.info["startup_time"] = datetime.now()
+        if heartbeat and filename != ":memory:":
+            try:
+                self.heartbeat = HeartbeatUpdater(self)
+            except EnvironmentError, e:
+                self.logger.warning("can't use heartbeat file: %s", e)
 
 
     def __del__(self):
         """Closes connection."""
 
+        self.close()
+
+
+    def close(self):
+        """Records shutdown time and closes connection and heartbeat file.
+
+        This is also done when the instance is deleted, and calling it again
+        does nothing.
+        """
+
+        if self.heartbeat is not None:
+            self.heartbeat.close()
+            self.heartbeat = None
         if self.conn is not None:
-            self.info["shutdown_time"] = datetime.now()
+            if self.session:
+                self.info["shutdown_time"] = datetime.now()
             self.conn.close()
             self.conn = None
 
@@ -472,38 +893,128 @@ class TimeTrackDB(object):
         """Creates tables if necessary."""
 
         create_tracklib_schema(self.logger, self.conn)
+        cur = self.conn.cursor()
+        cur.execute("SELECT sql FROM sqlite_master WHERE name='diary_fts'")
+        row = cur.fetchone()
+        self.search_module = None
+        if row is not None:
+            self.search_module = "fts5" if "fts5" in row[0] else "fts4"
+        cur.execute("SELECT name FROM sqlite_master"
+                    " WHERE name='todos_trigram'")
+        self.todo_index = cur.fetchone() is not None
+
+
+    def transaction(self):
+        """Returns a context manager for a transaction around other calls.
+
+        Methods called within a ``with db.transaction():`` block don't commit
+        their changes individually - all are committed together when the
+        block exits, or rolled back if it raises an exception. Blocks may be
+        nested, in which case an exception leaving an inner block only rolls
+        back the changes made within that block.
+        """
+
+        return self.conn
+
+
+    def get_data_version(self):
+        """Returns a value which changes whenever the database is modified.
+
+        This is intended for callers which cache query results. PRAGMA
+        data_version changes when another connection commits, and the
+        total_changes count of this connection covers changes made through it.
+        """
+
+        cur = self.conn.cursor()
+        cur.execute("PRAGMA data_version")
+        return (cur.fetchone()[0], self.conn.total_changes)
+
+
+    def get_info_times(self):
+        """Returns a dict of the times recorded in info, by name.
+
+        The lastseen_time is taken from the heartbeat file instead if that
+        is more recent, since it's updated without writing to the database.
+        """
+
+        times = dict((key, self.info[key]) for key in self.info
+                     if key.endswith("_time"))
+        if self.filename != ":memory:":
+            heartbeat = read_heartbeat(get_heartbeat_filename(self.filename))
+            last_seen = times.get("lastseen_time", None)
+            if heartbeat is not None and (last_seen is None or
+                                          heartbeat > last_seen):
+                times["lastseen_time"] = heartbeat
+        return times
+
+
+    def _get_current_state(self):
+        """Return tuple of (log entry id, task name, task id, start) or None.
+
+        The result is cached until get_data_version() changes, so repeated
+        calls between modifications to the database don't query it again.
+        The start is a local datetime.
+        """
+
+        version = self.get_data_version()
+        if version != self.current_state_version:
+            cur = self.conn.cursor()
+            cur.execute("SELECT L.id, T.name, L.task, L.start"
+                        " FROM tasklog AS L"
+                        " INNER JOIN tasks AS T ON L.task=T.id"
+                        " WHERE L.end IS NULL")
+            row = cur.fetchone()
+            if row is None:
+                self.current_state = None
+            else:
+                self.current_state = (row[0], row[1], row[2],
+                                      datetime.fromtimestamp(row[3]))
+            self.current_state_version = version
+        return self.current_state
+
+
+    def _set_current_state(self, state):
+        """Updates the cached current state after a change to it.
+
+        Inside a transaction the cache is simply left to be refreshed, since
+        the change may yet be rolled back.
+        """
+
+        if self.conn.depth == 0:
+            self.current_state = state
+            self.current_state_version = self.get_data_version()
 
 
     def _get_current_task_with_id(self):
         """Return tuple of (log entry id, task name) or None."""
 
-        cur = self.conn.cursor()
-        cur.execute("SELECT L.id, T.name FROM tasklog AS L"
-                    " INNER JOIN tasks AS T ON L.task=T.id"
-                    " WHERE L.end IS NULL")
-        row = cur.fetchone()
-        if row is None:
+        state = self._get_current_state()
+        if state is None:
             return None
         else:
-            return row
+            return state[:2]
 
 
     def _get_previous_task_and_time_with_id(self):
         """Return tuple of (log entry id, task name) or None."""
 
-        task = self._get_current_task_with_id()
+        # task_recency holds each task's latest entry, indexed by its end,
+        # so this doesn't need to scan the whole of tasklog.
+        state = self._get_current_state()
         cur = self.conn.cursor()
-        if task is None:
-            cur.execute("SELECT L.id, T.name, L.start, L.end FROM tasklog AS L"
-                        " INNER JOIN tasks AS T ON L.task=T.id"
-                        " WHERE L.end is NOT NULL"
-                        " ORDER BY L.end DESC LIMIT 1")
+        if state is None:
+            cur.execute("SELECT R.last_entry, T.name, R.last_start, R.last_end"
+                        " FROM task_recency AS R"
+                        " INNER JOIN tasks AS T ON R.task=T.id"
+                        " WHERE R.last_end IS NOT NULL"
+                        " ORDER BY R.last_end DESC, R.last_entry DESC LIMIT 1")
         else:
-            cur_task_id = self.tasks.get_id(task[1])
-            cur.execute("SELECT L.id, T.name, L.start, L.end FROM tasklog AS L"
-                        " INNER JOIN tasks AS T ON L.task=T.id"
-                        " WHERE L.end IS NOT NULL AND L.task!=?"
-                        " ORDER BY L.end DESC LIMIT 1", (cur_task_id,))
+            cur.execute("SELECT R.last_entry, T.name, R.last_start, R.last_end"
+                        " FROM task_recency AS R"
+                        " INNER JOIN tasks AS T ON R.task=T.id"
+                        " WHERE R.last_end IS NOT NULL AND R.task!=?"
+                        " ORDER BY R.last_end DESC, R.last_entry DESC"
+                        " LIMIT 1", (state[2],))
         row = cur.fetchone()
         if row is None:
             return None
@@ -550,16 +1061,76 @@ class TimeTrackDB(object):
             return row[0]
 
 
+    def get_recent_tasks(self, limit=None, frecency=False):
+        """Returns a list of (task, last start, uses) for recent tasks.
+
+        Tasks are ordered by the start of their most recent entry, or if
+        frecency is True then by their number of entries weighted by how
+        recently they were used, so tasks used both often and lately come
+        first. The last start is a local datetime. Tasks without log entries
+        aren't included.
+        """
+
+        cur = self.conn.cursor()
+        if frecency:
+            now = int(time.time())
+            order_sql = ("R.uses * CASE"
+                         " WHEN R.last_start >= ? THEN 4.0"
+                         " WHEN R.last_start >= ? THEN 2.0"
+                         " WHEN R.last_start >= ? THEN 1.0"
+                         " ELSE 0.5 END DESC,"
+                         " R.last_start DESC, R.last_entry DESC")
+            params = [now - days * 86400 for days in (1, 7, 30)]
+        else:
+            order_sql = "R.last_start DESC, R.last_entry DESC"
+            params = []
+        sql = ("SELECT T.name, R.last_start, R.uses FROM task_recency AS R"
+               " INNER JOIN tasks AS T ON R.task=T.id"
+               " WHERE R.uses > 0 ORDER BY " + order_sql)
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        cur.execute(sql, params)
+        return [(row[0], datetime.fromtimestamp(row[1]), row[2])
+                for row in cur]
+
+
     def get_current_task_start(self):
         """Returns the start time of the current task as a local datetime."""
 
-        cur = self.conn.cursor()
-        cur.execute("SELECT start FROM tasklog WHERE end IS NULL")
-        row = cur.fetchone()
-        if row is None:
+        state = self._get_current_state()
+        if state is None:
+            return None
+        else:
+            return state[3]
+
+
+    def get_current_task_and_start(self):
+        """As get_current_task() but returns a tuple: (task, start)."""
+
+        state = self._get_current_state()
+        if state is None:
             return None
         else:
-            return datetime.fromtimestamp(row[0])
+            return (state[1], state[3])
+
+
+    def _end_task(self, state, epoch_time, completed):
+        """Ends the log entry of the current state, within a transaction.
+
+        Returns a dict of the times to be set in info, so that the caller
+        can set them along with any of its own.
+        """
+
+        cur = self.conn.cursor()
+        cur.execute("UPDATE tasklog SET end=? WHERE id=?",
+                    (epoch_time, state[0]))
+        info_times = {"taskstop_time": datetime.fromtimestamp(epoch_time)}
+        if completed:
+            cur.execute("UPDATE tasks SET completed=? WHERE id=?",
+                        (epoch_time, state[2]))
+            info_times["taskdone_time"] = info_times["taskstop_time"]
+        return info_times
 
 
     def end_current_task(self, epoch_time=None, completed=False):
@@ -568,25 +1139,19 @@ class TimeTrackDB(object):
         if epoch_time is None:
             epoch_time = int(time.time())
 
-        task = self._get_current_task_with_id()
-        if task is not None:
-            cur = self.conn.cursor()
-            self.info["taskstop_time"] = datetime.fromtimestamp(epoch_time)
-            with self.conn:
-                cur.execute("UPDATE tasklog SET end=? WHERE id=?",
-                            (epoch_time, task[0]))
-                if completed:
-                    cur_task_id = self.tasks.get_id(task[1])
-                    self.info["taskdone_time"] = datetime.fromtimestamp(epoch_time)
-                    cur.execute("UPDATE tasks SET completed=? WHERE id=?",
-                                (epoch_time, cur_task_id))
+        with self.conn.immediate():
+            state = self._get_current_state()
+            if state is None:
+                return
+            self.info.update(self._end_task(state, epoch_time, completed))
+        self._set_current_state(None)
 
 
     def get_latest_task_end(self):
         """Returns datetime of most recent task ending."""
 
         cur = self.conn.cursor()
-        cur.execute("SELECT MAX(end) FROM tasklog WHERE end IS NOT NULL")
+        cur.execute("SELECT MAX(end) FROM tasklog")
         row = cur.fetchone()
         if row is None or row[0] is None:
             return None
@@ -595,50 +1160,65 @@ class TimeTrackDB(object):
 
 
     def start_task(self, task, at_datetime=None, completed=False):
-        """Starts a new task, ending any current task in the process."""
+        """Starts a new task, ending any current task in the process.
+
+        This takes the database's write lock before checking the current
+        task, so another process can't start or stop a task in between.
+        """
 
         # Work out the time to use as 'now'.
         if at_datetime is None:
             at_datetime = datetime.now()
         epoch_time = time.mktime(at_datetime.timetuple())
 
-        # Check current task to see if we need to make any changes.
-        cur_task = self._get_current_task_with_id()
-        if cur_task is not None:
-            cur_start = self.get_current_task_start()
-            if at_datetime < cur_start:
-                raise TimeTrackError("can't stop current task at a time"
-                                     " earlier than its start (%s)" %
-                                     (cur_start.isoformat(),))
-        else:
-            latest_end = self.get_latest_task_end()
-            if latest_end is not None and at_datetime < latest_end:
-                raise TimeTrackError("can't start new task at a time"
-                                     " earlier than latest previous task"
-                                     " ended (%s)" % (latest_end.isoformat(),))
-
-        if task is None:
-            if cur_task is None:
-                # No change
-                return
-            new_task_id = None
-        else:
-            if cur_task is not None and task == cur_task[1]:
-                # No change
-                return
-            new_task_id = self.tasks.get_id(task)
-
-        # Stop current task.
-        self.end_current_task(epoch_time, completed=completed)
+        with self.conn.immediate():
+            # Check current task to see if we need to make any changes.
+            state = self._get_current_state()
+            if state is not None:
+                if at_datetime < state[3]:
+                    raise TimeTrackError("can't stop current task at a time"
+                                         " earlier than its start (%s)" %
+                                         (state[3].isoformat(),))
+            else:
+                latest_end = self.get_latest_task_end()
+                if latest_end is not None and at_datetime < latest_end:
+                    raise TimeTrackError("can't start new task at a time"
+                                         " earlier than latest previous task"
+                                         " ended (%s)"
+                                         % (latest_end.isoformat(),))
 
-        # If new task specified, start it.
-        if new_task_id is not None:
-            cur = self.conn.cursor()
-            self.info["taskstart_time"] = datetime.fromtimestamp(epoch_time)
-            with self.conn:
+            if task is None:
+                if state is None:
+                    # No change
+                    return
+                new_task_id = None
+            else:
+                if state is not None and task == state[1]:
+                    # No change
+                    return
+                new_task_id = self.tasks.get_id(task)
+
+            # Stop current task and, if new task specified, start it.
+            info_times = {}
+            new_state = None
+            if state is not None:
+                info_times = self._end_task(state, epoch_time, completed)
+            if new_task_id is not None:
+                cur = self.conn.cursor()
                 cur.execute("INSERT INTO tasklog (task, start, end)"
                             " VALUES (?, ?, NULL)",
                             (new_task_id, epoch_time))
+                entry_id = cur.lastrowid
+                # The task may have been given in a different case to its
+                # name, so the state must hold the name as stored.
+                cur.execute("SELECT name FROM tasks WHERE id=?",
+                            (new_task_id,))
+                new_state = (entry_id, cur.fetchone()[0], new_task_id,
+                             datetime.fromtimestamp(epoch_time))
+                info_times["taskstart_time"] = new_state[3]
+            self.info.update(info_times)
+
+        self._set_current_state(new_state)
 
 
     def stop_task(self, at_datetime=None, completed=False):
@@ -758,17 +1338,18 @@ class TimeTrackDB(object):
         # Work out the task active at the specified time.
         if at_datetime is None:
             at_datetime = datetime.now()
-            task = self.get_current_task()
-            if task is None:
+            state = self._get_current_state()
+            if state is None:
                 raise TimeTrackError("no task currently active")
+            task, task_id = state[1:3]
         else:
             task = self.get_task_at_time(at_datetime)
             if task is None:
                 raise TimeTrackError("no task active at %r" % (at_datetime,))
+            task_id = self.tasks.get_id(task)
 
         # Add entry to appropriate task.
         epoch_time = time.mktime(at_datetime.timetuple())
-        task_id = self.tasks.get_id(task)
         cur = self.conn.cursor()
         with self.conn:
             self.info["diaryentry_time"] = at_datetime
@@ -801,33 +1382,41 @@ class TimeTrackDB(object):
         # Work out the task active at the specified time.
         if at_datetime is None:
             at_datetime = datetime.now()
-            task = self.get_current_task()
-            if task is None:
+            state = self._get_current_state()
+            if state is None:
                 raise TimeTrackError("no task currently active")
+            task, task_id = state[1:3]
         else:
             task = self.get_task_at_time(at_datetime)
             if task is None:
                 raise TimeTrackError("no task active at %r" % (at_datetime,))
+            task_id = self.tasks.get_id(task)
 
-        # Update value in database.
+        # Find matching todos with the trigram index if there is one, and
+        # update the todo by ID only if the description matched just one.
+        # The index can't look up fewer than three characters, and the
+        # CROSS JOIN stops SQLite using it once for every todo of the task.
+        if self.todo_index and len(desc) >= 3:
+            match_sql = ("SELECT O.id FROM todos_trigram AS F"
+                         " CROSS JOIN todos AS O ON O.id=F.rowid"
+                         " WHERE F.description LIKE ? AND O.task=?")
+        else:
+            match_sql = ("SELECT id FROM todos"
+                         " WHERE description LIKE ? AND task=?")
         epoch_time = time.mktime(at_datetime.timetuple())
-        task_id = self.tasks.get_id(task)
         cur = self.conn.cursor()
         with self.conn:
-            cur.execute("SELECT id FROM todos WHERE task=?"
-                        " AND description LIKE ?",
-                        (task_id, "%" + desc + "%"))
-            matches = sum(1 for row in cur)
-            if matches == 0:
+            cur.execute(match_sql, ("%" + desc + "%", task_id))
+            matches = cur.fetchall()
+            if not matches:
                 raise TimeTrackError("todo not found for task %s: %s"
                                      % (task, desc))
-            elif matches > 1:
+            elif len(matches) > 1:
                 raise TimeTrackError("%d todo matches found for task %s: %s"
-                                     % (matches, task, desc))
+                                     % (len(matches), task, desc))
             self.info["tododone_time"] = at_datetime
-            cur.execute("UPDATE todos SET done=? WHERE task=?"
-                        " AND description LIKE ?",
-                        (epoch_time, task_id, "%" + desc + "%"))
+            cur.execute("UPDATE todos SET done=? WHERE id=?",
+                        (epoch_time, matches[0][0]))
 
 
     def get_pending_todos(self, task=None, tag=None, at_datetime=None):
@@ -847,9 +1436,9 @@ class TimeTrackDB(object):
             where_clauses.append("O.task=?")
             args.append(self.tasks.get_id(task))
         elif tag is not None:
-            tasks = self.get_tag_tasks(tag)
-            where_clauses.append("T.name IN ('%s')" %
-                                 ("','".join(str(i) for i in tasks),))
+            where_clauses.append("O.task IN (SELECT task FROM tagmappings"
+                                 " WHERE tag=?)")
+            args.append(self.tags.get_id(tag))
 
         cur = self.conn.cursor()
         cur.execute("SELECT O.added, T.name, O.description FROM todos AS O"
@@ -860,7 +1449,124 @@ class TimeTrackDB(object):
         return [(datetime.fromtimestamp(row[0]), row[1], row[2]) for row in cur]
 
 
-    def get_task_log_entries(self, start=None, end=None, tags=None, tasks=None):
+    def search_diary(self, query, start=None, end=None, tags=None,
+                     limit=None):
+        """Return diary entries and todo items matching a text search.
+
+        The query is a list of words and quoted phrases which must all
+        appear, where a word ending in "*" matches any word starting with
+        it. Any other punctuation is treated as it would be in the text
+        searched. Where SQLite supports full-text search, words and phrases
+        may also be combined using OR, and with FTS5 using NOT - otherwise
+        those operators raise TimeTrackError rather than being taken as
+        words. If start and/or end are specified, only items from that
+        period are returned, and tags restricts the results to tasks with
+        any of the specified tags.
+
+        Returns a list of (datetime, task, description) tuples in the same
+        form as diary entries, best matches first (or most recent first
+        where SQLite doesn't support ranking). Todo items have a "[TODO] "
+        or "[DONE] " prefix and the time they were added or completed.
+        """
+
+        if query.count('"') % 2:
+            raise TimeTrackError("invalid search: unterminated phrase")
+
+        # Quote every word so that punctuation within it isn't taken as
+        # query syntax, leaving only the supported operators and prefixes.
+        # Without an index, just require all words and phrases to be present.
+        operators = SEARCH_OPERATORS[self.search_module]
+        match_terms = []
+        like_args = []
+        for term in SEARCH_TERM_RE.findall(query):
+            if term in ("OR", "NOT"):
+                if term not in operators:
+                    raise TimeTrackError("invalid search: %s isn't supported"
+                                         " by this version of SQLite"
+                                         % (term,))
+                match_terms.append(term)
+                continue
+            if term.startswith('"'):
+                text, prefix = term[1:-1], False
+            else:
+                text, prefix = term.rstrip("*"), term.endswith("*")
+            if not text:
+                continue
+            quoted = '"%s"' % (text.replace('"', '""'),)
+            if prefix:
+                # FTS4 prefixes are within the quotes, FTS5 ones follow them.
+                if self.search_module == "fts5":
+                    quoted += "*"
+                else:
+                    quoted = quoted[:-1] + '*"'
+            match_terms.append(quoted)
+            like_args.append("%" + text + "%")
+        if not like_args:
+            return []
+        if self.search_module is not None:
+            match_args = [" ".join(match_terms)]
+        else:
+            match_args = like_args
+        rank_sql = "F.rank" if self.search_module == "fts5" else "0"
+
+        # Build filters, which are the same for both tables other than the
+        # expression for the item's time.
+        where_items = []
+        where_args = []
+        if start is not None:
+            where_items.append("%(time)s >= ?")
+            where_args.append(time.mktime(start.timetuple()))
+        if end is not None:
+            where_items.append("%(time)s < ?")
+            where_args.append(time.mktime(end.timetuple()))
+        if tags is not None:
+            try:
+                tag_ids = [self.tags.get_id(i) for i in tags]
+            except KeyError, e:
+                raise TimeTrackError("tag not found: %s" % (e,))
+            where_items.append("T.id IN (SELECT task FROM tagmappings"
+                               " WHERE tag IN (%s))"
+                               % (",".join(str(i) for i in tag_ids),))
+
+        selects = []
+        args = []
+        for table, alias, time_sql, desc_sql in (
+                ("diary", "D", "D.time", "D.description"),
+                ("todos", "O", "(CASE WHEN O.done>0 THEN O.done"
+                               " ELSE O.added END)",
+                 "(CASE WHEN O.done>0 THEN '[DONE] ' ELSE '[TODO] ' END"
+                 " || O.description)")):
+            if self.search_module is not None:
+                from_sql = ("%s_fts AS F INNER JOIN %s AS %s ON %s.id=F.rowid"
+                            % (table, table, alias, alias))
+                conditions = ["F.description MATCH ?"]
+            else:
+                from_sql = "%s AS %s" % (table, alias)
+                conditions = ["%s.description LIKE ?" % (alias,)
+                              for i in match_args]
+            conditions.extend(i % {"time": time_sql} for i in where_items)
+            selects.append("SELECT %s, T.name, %s, %s AS rank FROM %s"
+                           " INNER JOIN tasks AS T ON %s.task=T.id WHERE %s"
+                           % (time_sql, desc_sql, rank_sql, from_sql, alias,
+                              " AND ".join(conditions)))
+            args.extend(match_args + where_args)
+
+        sql = " UNION ALL ".join(selects) + " ORDER BY rank, 1 DESC"
+        if limit is not None:
+            sql += " LIMIT %d" % (limit,)
+        cur = self.conn.cursor()
+        try:
+            cur.execute(sql, args)
+            rows = cur.fetchall()
+        except sqlite3.OperationalError, e:
+            raise TimeTrackError("invalid search: %s" % (e,))
+        return [(datetime.fromtimestamp(row[0]), row[1], row[2])
+                for row in rows]
+
+
+    def get_task_log_entries(self, start=None, end=None, tags=None, tasks=None,
+                             limit=None, offset=None, after=None,
+                             descending=False):
         """Return TaskLogEntry instances matching specified criteria.
 
         If specified, start and end give times at which to bound the search,
@@ -871,6 +1577,18 @@ class TimeTrackDB(object):
         The tags parameter should be an iterable if specified, which restricts
         the results to tasks with the specified tags attached, or the tasks
         parameter can specify task names directly.
+
+        Entries are yielded in order of start time as they're read from the
+        database. To page through large result sets, limit restricts the
+        number of entries returned and offset skips over that many matching
+        entries first - skipped entries are never loaded, so this is much
+        cheaper than discarding them from the results.
+
+        Entries are yielded most recent first if descending is True. To resume
+        from a previous query, pass the cursor attribute of the last entry it
+        returned as after. Unlike offset this only reads the entries which
+        are returned, so the cost of fetching each page doesn't grow with the
+        number of pages already seen.
         """
         # Convert times to UTC timestamps and tags and tasks to sets.
         start = time.mktime(start.timetuple()) if start is not None else None
@@ -923,14 +1641,31 @@ class TimeTrackDB(object):
         if filter_tasks is not None:
             where_items.append("L.task IN (%s)" %
                                (",".join(str(i) for i in filter_tasks),))
+        if after is not None:
+            # Equivalent to (L.start, L.id) > after, but usable with the
+            # index on start.
+            op = "<" if descending else ">"
+            after_start = int(after[0])
+            where_items.append("L.start %s= %d AND (L.start %s %d OR"
+                               " L.id %s %d)" % (op, after_start, op,
+                                                 after_start, op,
+                                                 int(after[1])))
 
         where_clause = ""
         if where_items:
             where_clause = " WHERE %s" % (" AND ".join(where_items),)
 
+        # Order on ID as well as start so that pages are stable.
+        order = " DESC" if descending else ""
+        limit_clause = ""
+        if limit is not None or offset:
+            limit_clause = " LIMIT %d OFFSET %d" % (
+                    limit if limit is not None else -1, offset or 0)
+
         cur.execute("SELECT T.name, L.id, L.start, L.end FROM tasklog AS L"
                     " INNER JOIN tasks AS T ON L.task=T.id"
-                    "%s ORDER BY L.start" % (where_clause,))
+                    "%s ORDER BY L.start%s, L.id%s%s"
+                    % (where_clause, order, order, limit_clause))
         for row in cur:
             start_time = row[2]
             if start is not None and start_time < start:
@@ -942,8 +1677,10 @@ class TimeTrackDB(object):
                 end_time = end
             # We don't allow start and end to be mutable because of the way
             # we truncate them to the requested range.
-            yield TaskLogEntry(self.logger, self, row[0], row[1],
-                               start_time, end_time, mutable_times=False)
+            entry = TaskLogEntry(self.logger, self, row[0], row[1],
+                                 start_time, end_time, mutable_times=False)
+            entry.cursor = (row[2], row[1])
+            yield entry
 
 
     def set_task_estimate(self, task, time_secs):
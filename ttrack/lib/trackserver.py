@@ -0,0 +1,405 @@
+"""Local HTTP server exposing TimeTrackDB operations as JSON.
+
+This is intended for tools which poll ttrack frequently (status bar widgets,
+CI hooks and the like) and would otherwise pay the cost of starting a new
+process for every query. The server only binds to the loopback interface by
+default and performs no authentication.
+
+Requests are handled by a fixed pool of worker threads. As SQLite connections
+can't be shared between threads, each worker opens its own TimeTrackDB on
+first use and keeps it open along with caches of task and tag names and of
+recent summary results. These caches are discarded whenever the database is
+changed, whether by this server or by any other process.
+
+The following requests are supported, all of which return JSON objects:
+
+GET /status
+  Current and previous tasks.
+GET /tasks, GET /tags
+  Sorted lists of task and tag names.
+GET /summary?by=(task|tag)[&period=...|&start=...&end=...][&tag=...]
+  Time spent and context switches per task or tag. The period may either be
+  a phrase as accepted by the ``summary`` command (e.g. ``last week``) or
+  ``YYYY-MM-DD`` start (inclusive) and end (exclusive) dates. The default is
+  the current week.
+GET /entries[?limit=...][&after=...]
+  Task log entries, most recent first, in pages of ``limit`` entries
+  (default 50). If there may be more entries, ``next`` is set to a value to
+  pass as ``after`` to fetch the next page.
+GET /todos[?task=...|?tag=...]
+  Outstanding todo items.
+POST /start, POST /stop
+  Start or stop a task. The request body is a JSON object which may contain
+  ``task``, ``time`` (in ``YYYY-MM-DDTHH:MM:SS`` format) and, for stopping,
+  ``completed``.
+"""
+
+
+import BaseHTTPServer
+import json
+import Queue
+import sqlite3
+import threading
+import urlparse
+from datetime import date, datetime, timedelta
+
+from cmdparser import datetimeparse
+import tracklib
+
+
+DEFAULT_PORT = 8417
+DEFAULT_POOL_SIZE = 4
+MAX_CACHED_SUMMARIES = 64
+DEFAULT_ENTRIES_LIMIT = 50
+MAX_ENTRIES_LIMIT = 1000
+MAX_REQUEST_BODY = 65536
+
+
+
+class RequestError(Exception):
+    """Raised by request handlers to return an error to the client."""
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+
+def parse_date(value):
+    """Converts a YYYY-MM-DD string to a date."""
+
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise RequestError(400, "invalid date: %r" % (value,))
+
+
+
+def parse_datetime(value):
+    """Converts a YYYY-MM-DDTHH:MM:SS string to a datetime."""
+
+    try:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+    except ValueError:
+        raise RequestError(400, "invalid time: %r" % (value,))
+
+
+
+def parse_cursor(value):
+    """Converts a cursor string from format_cursor() back to a tuple."""
+
+    start, sep, entry_id = value.partition(",")
+    if not sep or not start.isdigit() or not entry_id.isdigit():
+        raise RequestError(400, "invalid cursor: %r" % (value,))
+    return (int(start), int(entry_id))
+
+
+
+def format_cursor(cursor):
+    """Converts a TaskLogEntry cursor to a string."""
+
+    return "%d,%d" % cursor
+
+
+
+class WorkerState(object):
+    """Database connection and caches owned by a single worker thread."""
+
+    def __init__(self, logger, filename):
+        self.db = tracklib.TimeTrackDB(logger, filename=filename,
+                                      session=False)
+        self.period_tree = datetimeparse.PastCalendarPeriodSubtree("period")
+        self.version = None
+        self.names = {}
+        self.summaries = {}
+
+
+    def refresh(self):
+        """Discards cached results if the database has changed."""
+
+        version = self.db.get_data_version()
+        if version != self.version:
+            self.version = version
+            self.names.clear()
+            self.summaries.clear()
+
+
+    def get_names(self, kind):
+        """Returns sorted list of names from the "tasks" or "tags" set."""
+
+        if kind not in self.names:
+            self.names[kind] = sorted(getattr(self.db, kind))
+        return self.names[kind]
+
+
+    def get_period(self, query):
+        """Returns (start, end) dates from summary query parameters."""
+
+        if "period" in query:
+            fields = {}
+            error = self.period_tree.check_match(query["period"].split(),
+                                                 fields=fields)
+            if error is not None:
+                raise RequestError(400, "invalid period: %s" % (error,))
+            return fields["<period>"][0]
+        elif "start" in query or "end" in query:
+            if "start" not in query or "end" not in query:
+                raise RequestError(400, "both start and end are required")
+            return (parse_date(query["start"]), parse_date(query["end"]))
+        else:
+            start = date.today()
+            start -= timedelta(start.weekday())
+            return (start, start + timedelta(7))
+
+
+    def get_summary(self, by, start, end, tag):
+        """Returns summary dictionary for the specified period."""
+
+        key = (by, start, end, tag)
+        summary = self.summaries.get(key, None)
+        if summary is not None:
+            return summary
+
+        tags_arg = set((tag,)) if tag is not None else None
+        if by == "tag":
+            summary_obj = tracklib.TagSummaryGenerator()
+        else:
+            summary_obj = tracklib.TaskSummaryGenerator(tags=tags_arg)
+        summary_obj.read_entries(self.db.get_task_log_entries(start=start,
+                                                               end=end))
+        summary = {"by": by, "start": start.isoformat(),
+                   "end": end.isoformat(),
+                   "time": dict(summary_obj.total_time),
+                   "switches": dict(summary_obj.switches)}
+
+        # A running task within the period makes the totals time-dependent,
+        # so these can't be cached.
+        current_start = self.db.get_current_task_start()
+        end_datetime = datetime(end.year, end.month, end.day)
+        if current_start is None or current_start >= end_datetime:
+            if len(self.summaries) >= MAX_CACHED_SUMMARIES:
+                self.summaries.clear()
+            self.summaries[key] = summary
+        return summary
+
+
+
+class TrackRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Dispatches requests to methods named after the request path."""
+
+    server_version = "ttrack/" + tracklib.__version__
+
+
+    def do_GET(self):
+        self.dispatch("get")
+
+
+    def do_POST(self):
+        self.dispatch("post")
+
+
+    def log_message(self, fmt, *args):
+        self.server.logger.debug("%s - %s", self.client_address[0],
+                                 fmt % args)
+
+
+    def dispatch(self, method):
+        url = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        name = url.path.strip("/")
+        handler = getattr(self, method + "_" + name, None)
+        try:
+            if handler is None or not name.isalpha():
+                raise RequestError(404, "no such resource: %s" % (url.path,))
+            state = self.server.get_worker_state()
+            state.refresh()
+            if method == "post":
+                result = handler(state, self.read_body())
+            else:
+                result = handler(state, query)
+            self.send_json(200, result)
+        except RequestError, e:
+            self.send_json(e.code, {"error": str(e)})
+        except KeyError, e:
+            self.send_json(404, {"error": "not found: %s" % (e,)})
+        except tracklib.TimeTrackError, e:
+            self.send_json(400, {"error": str(e)})
+        except sqlite3.Error, e:
+            self.send_json(503, {"error": "database unavailable: %s" % (e,)})
+        except Exception, e:
+            self.server.logger.exception("error handling %s", self.path)
+            self.send_json(500, {"error": "internal error: %s" % (e,)})
+
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length > MAX_REQUEST_BODY:
+            raise RequestError(413, "request body too large")
+        body = self.rfile.read(length) if length else ""
+        try:
+            args = json.loads(body) if body else {}
+        except ValueError:
+            raise RequestError(400, "request body must be JSON")
+        if not isinstance(args, dict):
+            raise RequestError(400, "request body must be a JSON object")
+        return args
+
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj, sort_keys=True)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def get_status(self, state, query):
+        db = state.db
+        current = None
+        task = db.get_current_task()
+        if task is not None:
+            current = {"task": task,
+                       "start": db.get_current_task_start().isoformat()}
+        previous = None
+        prev = db.get_previous_task_and_time()
+        if prev is not None:
+            previous = {"task": prev[0], "duration": prev[1]}
+        return {"current": current, "previous": previous}
+
+
+    def get_tasks(self, state, query):
+        return {"tasks": state.get_names("tasks")}
+
+
+    def get_tags(self, state, query):
+        return {"tags": state.get_names("tags")}
+
+
+    def get_summary(self, state, query):
+        by = query.get("by", "task")
+        if by not in ("task", "tag"):
+            raise RequestError(400, "summary must be by task or tag")
+        tag = query.get("tag", None)
+        if tag is not None and by != "task":
+            raise RequestError(400, "tag filter only valid by task")
+        start, end = state.get_period(query)
+        if end < start:
+            raise RequestError(400, "end date before start date")
+        return state.get_summary(by, start, end, tag)
+
+
+    def get_entries(self, state, query):
+        limit = query.get("limit", str(DEFAULT_ENTRIES_LIMIT))
+        if not limit.isdigit() or not 0 < int(limit) <= MAX_ENTRIES_LIMIT:
+            raise RequestError(400, "limit must be from 1 to %d"
+                               % (MAX_ENTRIES_LIMIT,))
+        limit = int(limit)
+        after = None
+        if "after" in query:
+            after = parse_cursor(query["after"])
+        entries = list(state.db.get_task_log_entries(limit=limit, after=after,
+                                                     descending=True))
+        next_cursor = None
+        if len(entries) == limit:
+            next_cursor = format_cursor(entries[-1].cursor)
+        return {"entries": [{"id": entry.entry_id, "task": entry.task,
+                             "start": entry.start.isoformat(),
+                             "end": (entry.end.isoformat()
+                                     if entry.end is not None else None)}
+                            for entry in entries],
+                "next": next_cursor}
+
+
+    def get_todos(self, state, query):
+        todos = state.db.get_pending_todos(task=query.get("task", None),
+                                           tag=query.get("tag", None))
+        return {"todos": [{"added": added.isoformat(), "task": task,
+                           "description": desc}
+                          for added, task, desc in todos]}
+
+
+    def post_start(self, state, args):
+        if "task" not in args:
+            raise RequestError(400, "no task specified")
+        at_datetime = None
+        if "time" in args:
+            at_datetime = parse_datetime(args["time"])
+        state.db.start_task(args["task"], at_datetime=at_datetime)
+        return self.get_status(state, {})
+
+
+    def post_stop(self, state, args):
+        at_datetime = None
+        if "time" in args:
+            at_datetime = parse_datetime(args["time"])
+        state.db.stop_task(at_datetime=at_datetime,
+                           completed=bool(args.get("completed", False)))
+        return self.get_status(state, {})
+
+
+
+class TrackServer(BaseHTTPServer.HTTPServer):
+    """HTTP server which handles requests on a fixed pool of threads."""
+
+    def __init__(self, logger, filename=None, address=("127.0.0.1",
+                 DEFAULT_PORT), pool_size=DEFAULT_POOL_SIZE):
+        if filename == ":memory:":
+            raise tracklib.TimeTrackError("in-memory databases can't be"
+                                          " shared between threads")
+        BaseHTTPServer.HTTPServer.__init__(self, address, TrackRequestHandler)
+        self.logger = logger
+        self.filename = filename
+        self.local = threading.local()
+        self.requests = Queue.Queue(pool_size * 4)
+        self.workers = []
+        for i in xrange(pool_size):
+            worker = threading.Thread(target=self.process_request_queue)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+
+    def get_worker_state(self):
+        """Returns the WorkerState for the calling thread."""
+
+        state = getattr(self.local, "state", None)
+        if state is None:
+            state = WorkerState(self.logger, self.filename)
+            self.local.state = state
+        return state
+
+
+    def process_request(self, request, client_address):
+        """Queues request for the worker pool instead of handling it."""
+
+        self.requests.put((request, client_address))
+
+
+    def process_request_queue(self):
+        """Worker thread loop which handles queued requests."""
+
+        while True:
+            item = self.requests.get()
+            if item is None:
+                # Close this worker's database from its own thread.
+                self.local.state = None
+                break
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+    def server_close(self):
+        """Closes listening socket and stops worker threads."""
+
+        BaseHTTPServer.HTTPServer.server_close(self)
+        for worker in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join(1)
+        self.workers = []
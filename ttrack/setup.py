@@ -13,7 +13,7 @@ setup(name="ttrack",
       author="Andy Pearce",
       author_email="andy@andy-pearce.com",
       package_dir={"": "lib"},
-      py_modules=["tracklib"],
+      py_modules=["tracklib", "trackserver"],
       scripts=["bin/ttrack"],
       url="http://cartroo.github.com/ttrack/",
       license="LICENSE.txt",
@@ -3,7 +3,10 @@
 import cPickle
 import datetime
 import logging
+import os
+import shutil
 import sqlite3
+import tempfile
 import time
 import unittest
 
@@ -360,6 +363,192 @@ class TestTimeTrackDB(unittest.TestCase):
         self.assertTrue("tag2" in self.db.tags)
 
 
+    def test_prefixed_names(self):
+        for task in ("abc", "ab", "abd", "b", u"a\xe9", "a"):
+            self.db.tasks.add(task)
+        self.assertEqual(self.db.tasks.get_prefixed("ab"),
+                         ["ab", "abc", "abd"])
+        self.assertEqual(self.db.tasks.get_prefixed("a"),
+                         ["a", "ab", "abc", "abd", u"a\xe9"])
+        self.assertEqual(self.db.tasks.get_prefixed(u"a\xe9"), [u"a\xe9"])
+        self.assertEqual(self.db.tasks.get_prefixed(""),
+                         ["a", "ab", "abc", "abd", u"a\xe9", "b"])
+        self.assertEqual(self.db.tasks.get_prefixed("c"), [])
+        self.assertEqual(self.db.tags.get_prefixed("a"), [])
+
+
+    def test_transaction(self):
+        with self.db.transaction():
+            self.db.tasks.add("task1")
+            self.db.tags.add("tag1")
+            self.db.add_task_tag("task1", "tag1")
+        self.assertEqual(self.db.get_task_tags("task1"), set(("tag1",)))
+        try:
+            with self.db.transaction():
+                self.db.tasks.add("task2")
+                raise tracklib.TimeTrackError("abort")
+        except tracklib.TimeTrackError:
+            pass
+        self.assertFalse("task2" in self.db.tasks)
+        self.assertTrue("task1" in self.db.tasks)
+
+
+    def test_nested_transaction(self):
+        with self.db.transaction():
+            self.db.tasks.add("task1")
+            try:
+                with self.db.transaction():
+                    self.db.tasks.add("task2")
+                    self.db.add_task_tag("task2", "nosuchtag")
+            except tracklib.TimeTrackError:
+                pass
+            self.assertFalse("task2" in self.db.tasks)
+            with self.db.transaction():
+                self.db.tasks.add("task3")
+        self.assertEqual(set(self.db.tasks), set(("task1", "task3")))
+        try:
+            with self.db.transaction():
+                self.db.tasks.add("task4")
+                with self.db.transaction():
+                    self.db.tasks.add("task5")
+                raise tracklib.TimeTrackError("abort")
+        except tracklib.TimeTrackError:
+            pass
+        self.assertEqual(set(self.db.tasks), set(("task1", "task3")))
+
+
+    def test_failed_commit(self):
+        # A deferred foreign key is only checked when committing.
+        conn = self.db.conn
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute("CREATE TABLE parent (id INTEGER PRIMARY KEY)")
+        conn.execute("CREATE TABLE child (parent_id INTEGER REFERENCES"
+                     " parent (id) DEFERRABLE INITIALLY DEFERRED)")
+        with self.assertRaises(sqlite3.IntegrityError):
+            with conn:
+                conn.execute("INSERT INTO child VALUES (1)")
+        self.assertEqual(conn.depth, 0)
+        with self.db.transaction():
+            self.db.tasks.add("task1")
+        self.assertEqual(list(self.db.tasks), ["task1"])
+        self.assertEqual(conn.execute("SELECT * FROM child").fetchall(), [])
+
+
+    def test_data_version(self):
+        version = self.db.get_data_version()
+        self.assertEqual(self.db.get_data_version(), version)
+        self.db.tasks.add("task1")
+        self.assertNotEqual(self.db.get_data_version(), version)
+        version = self.db.get_data_version()
+        self.db.conn.execute("INSERT INTO tags (name) VALUES (?)", ("tag1",))
+        self.assertNotEqual(self.db.get_data_version(), version)
+
+
+    def test_read_only(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, "test?.db")
+            # A new database is created, but nothing else is written.
+            db = tracklib.TimeTrackDB(NullHandler(), filename=filename,
+                                      read_only=True)
+            self.assertTrue(db.read_only)
+            self.assertFalse("startup_time" in db.info)
+            self.assertRaises(sqlite3.OperationalError, db.tasks.add, "task1")
+            del db
+            db = tracklib.TimeTrackDB(NullHandler(), filename=filename)
+            db.tasks.add("task1")
+            db.start_task("task1")
+            startup_time = db.info["startup_time"]
+            del db
+
+            # Without URI support, the connection is made query-only.
+            old_get_read_only_uri = tracklib.get_read_only_uri
+            tracklib.get_read_only_uri = lambda filename: None
+            try:
+                db = tracklib.TimeTrackDB(NullHandler(), filename=filename,
+                                          read_only=True)
+            finally:
+                tracklib.get_read_only_uri = old_get_read_only_uri
+            self.assertTrue(db.read_only)
+            self.assertEqual(db.get_current_task(), "task1")
+            self.assertEqual(db.info["startup_time"], startup_time)
+            self.assertRaises(sqlite3.OperationalError, db.tasks.add, "task2")
+            del db
+
+            if tracklib.get_read_only_uri(filename) is None:
+                return
+            db = tracklib.TimeTrackDB(NullHandler(), filename=filename,
+                                      read_only=True)
+            self.assertTrue(db.read_only)
+            self.assertEqual(db.get_current_task(), "task1")
+            self.assertEqual(db.info["startup_time"], startup_time)
+            self.assertRaises(sqlite3.OperationalError, db.tasks.add, "task2")
+            del db
+            self.assertEqual(os.listdir(tmp_dir), ["test?.db"])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+    def test_heartbeat(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, "test.db")
+            db = tracklib.TimeTrackDB(NullHandler(), filename=filename)
+            self.assertEqual(db.heartbeat, None)
+            db.close()
+            db = tracklib.TimeTrackDB(NullHandler(), filename=filename,
+                                      heartbeat=True)
+            lastseen = datetime.datetime(2013, 3, 26, 10, 0)
+            db.info["lastseen_time"] = lastseen
+            db.info["shutdown_time"] = lastseen
+            self.assertEqual(db.get_info_times()["lastseen_time"], lastseen)
+            db.heartbeat.update()
+            heartbeat = tracklib.read_heartbeat(
+                    tracklib.get_heartbeat_filename(filename))
+            self.assertAlmostEqual(time.mktime(heartbeat.timetuple()),
+                                   time.time(), delta=1)
+            self.assertEqual(db.get_info_times()["lastseen_time"], heartbeat)
+            self.assertEqual(db.info["lastseen_time"], lastseen)
+
+            # Simulate a crash, which leaves no shutdown time recorded.
+            db.conn.close()
+            db.conn = None
+            db.close()
+            db = tracklib.TimeTrackDB(NullHandler(), filename=filename)
+            self.assertEqual(db.info["lastseen_time"], heartbeat)
+            self.assertEqual(db.info["shutdown_time"], heartbeat)
+            db.close()
+            db.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+    def test_heartbeat_close(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, "test.db")
+            db = tracklib.TimeTrackDB(NullHandler(), filename=filename,
+                                      heartbeat=True)
+            updater = db.heartbeat
+            db.close()
+            self.assertEqual((db.heartbeat, db.conn, updater.map),
+                             (None, None, None))
+
+            # Where open descriptors can be listed, check none remain.
+            heartbeat = tracklib.get_heartbeat_filename(filename)
+            if os.path.isdir("/proc/self/fd"):
+                links = []
+                for fd in os.listdir("/proc/self/fd"):
+                    try:
+                        links.append(os.readlink("/proc/self/fd/" + fd))
+                    except OSError:
+                        pass
+                self.assertNotIn(os.path.realpath(heartbeat), links)
+            del db
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
     def test_start_stop_task(self):
         # Add new task and start it.
         self.db.tasks.add("task1")
@@ -438,6 +627,36 @@ class TestTimeTrackDB(unittest.TestCase):
         self.assertEqual(entries[1][2], None)
 
 
+    def test_start_task_atomic(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, "test.db")
+            db1 = tracklib.TimeTrackDB(NullHandler(), filename=filename)
+            db2 = tracklib.TimeTrackDB(NullHandler(), filename=filename)
+            db1.tasks.add("task1")
+            db1.tasks.add("task2")
+            self.assertEqual(db2.get_current_task(), None)
+
+            # Each instance must see the task started by the other.
+            db1.start_task("task1")
+            db2.start_task("task2")
+            self.assertEqual(db1.get_current_task(), "task2")
+            cur = db1.conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM tasklog WHERE end IS NULL")
+            self.assertEqual(cur.fetchone()[0], 1)
+
+            # A failed switch must leave the current task running.
+            self.assertRaises(KeyError, db1.start_task, "nosuchtask")
+            self.assertEqual(db2.get_current_task(), "task2")
+            db1.stop_task(completed=True)
+            self.assertEqual(db2.get_current_task(), None)
+            self.assertEqual(db2.info["taskdone_time"],
+                             db2.info["taskstop_time"])
+            del db1, db2
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
     def test_current_task(self):
         self.db.tasks.add("task1")
         self.db.start_task("task1")
@@ -457,6 +676,94 @@ class TestTimeTrackDB(unittest.TestCase):
         self.assertEqual(self.db.get_previous_task_and_time(), ("task1", 1800))
 
 
+    def test_current_task_cache(self):
+        self.db.tasks.add("task1")
+        self.db.tasks.add("task2")
+        start = datetime.datetime(2013, 3, 26, 10, 0)
+        self.db.start_task("task1", start)
+        self.assertEqual(self.db.get_current_task_and_start(),
+                         ("task1", start))
+
+        # Changes made directly to the database must be noticed.
+        cur = self.db.conn.cursor()
+        cur.execute("UPDATE tasklog SET start=start-60")
+        start -= datetime.timedelta(minutes=1)
+        self.assertEqual(self.db.get_current_task_start(), start)
+        self.db.tasks.rename("task1", "task3")
+        self.assertEqual(self.db.get_current_task(), "task3")
+
+        # A change which is rolled back mustn't be cached.
+        try:
+            with self.db.transaction():
+                self.db.start_task("task2", start + datetime.timedelta(1))
+                raise tracklib.TimeTrackError("abort")
+        except tracklib.TimeTrackError:
+            pass
+        self.assertEqual(self.db.get_current_task_and_start(),
+                         ("task3", start))
+        self.db.stop_task(start + datetime.timedelta(1))
+        self.assertEqual(self.db.get_current_task_and_start(), None)
+
+
+    def test_current_task_cache_start(self):
+        # Starting a task caches its state straight away, with the name as
+        # stored even if given in a different case.
+        self.db.tasks.add("task1")
+        start = datetime.datetime(2013, 3, 26, 10, 0)
+        self.db.start_task("TASK1", start)
+        self.assertEqual(self.db.current_state_version,
+                         self.db.get_data_version())
+        cur = self.db.conn.cursor()
+        cur.execute("SELECT id FROM tasklog WHERE end IS NULL")
+        self.assertEqual(self.db.current_state,
+                         (cur.fetchone()[0], "task1",
+                          self.db.tasks.get_id("task1"), start))
+        self.assertEqual(self.db.get_current_task_and_start(),
+                         ("task1", start))
+
+
+    def test_recent_tasks(self):
+        now = datetime.datetime.now().replace(microsecond=0)
+        hour = datetime.timedelta(hours=1)
+        for task in ("task1", "task2", "task3", "task4"):
+            self.db.tasks.add(task)
+        for days in (22, 21, 20):
+            start = now - datetime.timedelta(days=days)
+            self.db.start_task("task1", start)
+            self.db.stop_task(start + hour)
+        for days in (11, 10):
+            start = now - datetime.timedelta(days=days)
+            self.db.start_task("task3", start)
+            self.db.stop_task(start + hour)
+        self.db.start_task("task2", now - 2 * hour)
+        self.db.stop_task(now - hour)
+
+        self.assertEqual(self.db.get_recent_tasks(),
+                         [("task2", now - 2 * hour, 1),
+                          ("task3", now - datetime.timedelta(days=10), 2),
+                          ("task1", now - datetime.timedelta(days=20), 3)])
+        self.assertEqual([i[0] for i in self.db.get_recent_tasks(limit=2)],
+                         ["task2", "task3"])
+        self.assertEqual([i[0] for i in self.db.get_recent_tasks(
+                              frecency=True)], ["task2", "task1", "task3"])
+
+        # Moving an entry between tasks updates both of them.
+        cur = self.db.conn.cursor()
+        cur.execute("UPDATE tasklog SET task=? WHERE task=?",
+                    (self.db.tasks.get_id("task4"),
+                     self.db.tasks.get_id("task2")))
+        self.assertEqual(self.db.get_recent_tasks(limit=1),
+                         [("task4", now - 2 * hour, 1)])
+
+        # Removing entries or tasks removes them from the list.
+        for entry in self.db.get_task_log_entries(tasks=("task4",)):
+            entry.delete()
+        self.db.tasks.discard("task3")
+        self.assertEqual(self.db.get_recent_tasks(),
+                         [("task1", now - datetime.timedelta(days=20), 3)])
+        self.assertEqual(self.db.get_previous_task(), "task1")
+
+
     def test_add_task_tags(self):
         self.db.tasks.add("task1")
         self.db.tasks.add("task2")
@@ -589,6 +896,7 @@ class TestTimeTrackDB(unittest.TestCase):
         self.db.start_task("task1")
         with self.assertRaises(tracklib.TimeTrackError):
             self.db.mark_todo_done("Test todo")
+        self.assertEqual(len(self.db.get_pending_todos()), 2)
 
 
     def test_mark_todo_done_unique_within_task_prefix(self):
@@ -613,6 +921,28 @@ class TestTimeTrackDB(unittest.TestCase):
         self.assertAlmostEqual(entries[1][2], 0)
 
 
+    def test_mark_todo_done_index(self):
+        # Todos should match the same way whether or not the trigram index
+        # is used, including by strings too short for it to look up.
+        self.assertTrue(self.db.todo_index)
+        self.db.tasks.add("task1")
+        self.db.start_task("task1")
+        for use_index in (True, False):
+            self.db.todo_index = use_index
+            for desc in ("Fix the widget", "Polish the gadget", "Go"):
+                self.db.add_task_todo("task1", desc)
+            self.assertRaises(tracklib.TimeTrackError,
+                              self.db.mark_todo_done, "the")
+            self.assertRaises(tracklib.TimeTrackError,
+                              self.db.mark_todo_done, "gizmo")
+            self.db.mark_todo_done("THE WIDG")
+            self.db.mark_todo_done("go")
+            self.assertEqual([i[2] for i in self.db.get_pending_todos()],
+                             ["Polish the gadget"])
+            cur = self.db.conn.cursor()
+            cur.execute("DELETE FROM todos")
+
+
     def test_set_task_due(self):
         # Add new task and check due date is None.
         self.db.tasks.add("task1")
@@ -1044,6 +1374,180 @@ class TestTimeTrackDB(unittest.TestCase):
         self.assertEqual(len(entries[1].diary), 0)
 
 
+    def test_query_limit_offset(self):
+        self._create_sample_task_logs()
+        all_entries = [i.entry_id for i in self.db.get_task_log_entries()]
+        self.assertEqual(len(all_entries), 8)
+        entries = list(self.db.get_task_log_entries(limit=3))
+        self.assertEqual([i.entry_id for i in entries], all_entries[:3])
+        entries = list(self.db.get_task_log_entries(limit=3, offset=3))
+        self.assertEqual([i.entry_id for i in entries], all_entries[3:6])
+        entries = list(self.db.get_task_log_entries(offset=6))
+        self.assertEqual([i.entry_id for i in entries], all_entries[6:])
+        entries = list(self.db.get_task_log_entries(tasks=('task1', 'task2'),
+                                                    limit=2, offset=1))
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0].task, 'task2')
+        self.assertEqual(entries[1].task, 'task1')
+
+
+    def test_query_after_cursor(self):
+        self._create_sample_task_logs()
+        all_entries = [i.entry_id for i in self.db.get_task_log_entries()]
+        pages = []
+        after = None
+        while True:
+            page = list(self.db.get_task_log_entries(limit=3, after=after))
+            if not page:
+                break
+            pages.append([i.entry_id for i in page])
+            after = page[-1].cursor
+        self.assertEqual(pages, [all_entries[0:3], all_entries[3:6],
+                                 all_entries[6:8]])
+
+        # Cursors refer to the original start, not the truncated one.
+        entries = list(self.db.get_task_log_entries(
+                start=datetime.datetime(2011, 1, 1, 12, 5, 0), limit=1))
+        self.assertEqual(entries[0].start,
+                         datetime.datetime(2011, 1, 1, 12, 5, 0))
+        self.assertTrue(entries[0].cursor[0] <
+                        time.mktime(entries[0].start.timetuple()))
+        entries = list(self.db.get_task_log_entries(after=entries[0].cursor))
+        self.assertEqual([i.entry_id for i in entries], all_entries[3:])
+
+
+    def test_query_descending(self):
+        self._create_sample_task_logs()
+        all_entries = [i.entry_id for i in self.db.get_task_log_entries()]
+        entries = list(self.db.get_task_log_entries(descending=True))
+        self.assertEqual([i.entry_id for i in entries], all_entries[::-1])
+        entries = list(self.db.get_task_log_entries(descending=True, limit=2))
+        self.assertEqual([i.entry_id for i in entries], all_entries[:-3:-1])
+        entries = list(self.db.get_task_log_entries(descending=True, limit=3,
+                                                    after=entries[-1].cursor))
+        self.assertEqual([i.entry_id for i in entries], all_entries[-3:-6:-1])
+
+
+    def test_search_diary(self):
+        self._create_sample_task_logs()
+        # Equally good matches are listed most recent first.
+        self.assertEqual(self.db.search_diary("two OR three"),
+                         [(datetime.datetime(2011, 1, 1, 13, 30, 0),
+                           "task1", "three"),
+                          (datetime.datetime(2011, 1, 1, 13, 0, 0),
+                           "task1", "two")])
+        results = self.db.search_diary("todo", tags=("tag1",))
+        self.assertEqual(results, [(datetime.datetime(2011, 1, 2, 10, 15, 0),
+                                    "task3", "[DONE] Todo for task3")])
+        results = self.db.search_diary("todo",
+                                       start=datetime.datetime(2011, 1, 1,
+                                                               10, 35, 0),
+                                       end=datetime.datetime(2011, 1, 2))
+        self.assertEqual(results, [(datetime.datetime(2011, 1, 1, 10, 35, 5),
+                                    "task2", "[DONE] Todo for task2")])
+        results = self.db.search_diary("task4")
+        self.assertEqual(results, [(datetime.datetime(2011, 1, 1, 10, 31, 20),
+                                    "task4", "[TODO] Todo for task4")])
+        self.assertEqual(len(self.db.search_diary("todo", limit=2)), 2)
+
+        # The index must follow changes and deletions.
+        self.db.tasks.discard("task1")
+        self.assertEqual(self.db.search_diary("two"), [])
+        cur = self.db.conn.cursor()
+        cur.execute("UPDATE todos SET description='Renamed' WHERE task=4")
+        self.assertEqual(self.db.search_diary("task4"), [])
+        self.assertEqual(len(self.db.search_diary("renamed")), 1)
+        self.assertRaises(tracklib.TimeTrackError, self.db.search_diary,
+                          '"unterminated')
+        self.assertRaises(tracklib.TimeTrackError, self.db.search_diary,
+                          "todo", tags=("nosuchtag",))
+        self.assertEqual(self.db.search_diary("  "), [])
+
+        # Without an index, phrases and prefixes still work but operators
+        # are rejected rather than being taken as words.
+        self.db.search_module = None
+        results = [(datetime.datetime(2011, 1, 2, 10, 15, 0), "task3",
+                    "[DONE] Todo for task3")]
+        self.assertEqual(self.db.search_diary('"for task3"'), results)
+        self.assertEqual(self.db.search_diary("todo task3*"), results)
+        self.assertEqual(self.db.search_diary('"for task3" nomatch'), [])
+        self.assertRaises(tracklib.TimeTrackError, self.db.search_diary,
+                          "two OR three")
+        self.assertRaises(tracklib.TimeTrackError, self.db.search_diary,
+                          '"unterminated')
+
+
+    def test_search_diary_syntax(self):
+        self.db.tasks.add("task1")
+        task_id = self.db.tasks.get_id("task1")
+        cur = self.db.conn.cursor()
+        for desc in ("Fixed cache-outage in Bob's code", "Cache tuning"):
+            cur.execute("INSERT INTO diary (task, description, time)"
+                        " VALUES (?, ?, 0)", (task_id, desc))
+        def search(query):
+            return sorted(i[2] for i in self.db.search_diary(query))
+        both = ["Cache tuning", "Fixed cache-outage in Bob's code"]
+        fixed = both[1:]
+
+        for module in ("fts5", "fts4", None):
+            if module is not None:
+                for table in ("diary", "todos"):
+                    cur.execute("DROP TABLE %s_fts" % (table,))
+                    cur.execute("SELECT name FROM sqlite_master WHERE"
+                                " type='trigger' AND name LIKE ?",
+                                (table + "_fts_%",))
+                    for trigger in [row[0] for row in cur.fetchall()]:
+                        cur.execute("DROP TRIGGER %s" % (trigger,))
+                    self.assertTrue(tracklib.create_search_index(
+                            cur, table, modules=(module,)))
+            self.db.search_module = module
+            self.assertEqual(search("cache"), both)
+            self.assertEqual(search("cache-outage"), fixed)
+            self.assertEqual(search("bob's"), fixed)
+            self.assertEqual(search('"cache-outage in"'), fixed)
+            self.assertEqual(search("outa* cach*"), fixed)
+            self.assertEqual(search("cache nomatch"), [])
+            self.assertEqual(search('""'), [])
+            if module is not None:
+                self.assertEqual(search("tuning OR bob's"), both)
+                self.assertRaises(tracklib.TimeTrackError, search, "cache OR")
+            else:
+                self.assertRaises(tracklib.TimeTrackError, search,
+                                  "tuning OR bob's")
+            if module == "fts5":
+                self.assertEqual(search("cache NOT tuning"), fixed)
+            else:
+                self.assertRaises(tracklib.TimeTrackError, search,
+                                  "cache NOT tuning")
+
+
+    def test_search_index_rebuild(self):
+        # Create a database with diary entries but without search indexes,
+        # as for one created by an older version.
+        conn = sqlite3.connect(":memory:")
+        tracklib.create_tracklib_schema(NullHandler(), conn)
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type='trigger'")
+        for trigger in [row[0] for row in cur]:
+            cur.execute("DROP TRIGGER %s" % (trigger,))
+        cur.execute("DROP TABLE diary_fts")
+        cur.execute("DROP TABLE todos_fts")
+        cur.execute("DROP TABLE todos_trigram")
+        cur.execute("INSERT INTO diary (task, description, time)"
+                    " VALUES (1, 'existing entry', 0)")
+        cur.execute("INSERT INTO todos (task, description, added, done)"
+                    " VALUES (1, 'existing todo', 0, 0)")
+        conn.commit()
+        tracklib.create_tracklib_schema(NullHandler(), conn)
+        cur.execute("SELECT rowid FROM diary_fts WHERE diary_fts MATCH"
+                    " 'existing'")
+        self.assertEqual(list(cur), [(1,)])
+        cur.execute("SELECT rowid FROM todos_trigram"
+                    " WHERE description LIKE '%sting to%'")
+        self.assertEqual(list(cur), [(1,)])
+        conn.close()
+
+
     def test_task_summary_generator(self):
         self._create_sample_task_logs()
         gen = tracklib.TaskSummaryGenerator()
@@ -1190,6 +1694,20 @@ class TestTimeTrackDB(unittest.TestCase):
                           "task4", "Todo for task4"))
 
 
+    def test_pending_todos_filter_tag(self):
+        self._create_sample_task_logs()
+        todos = self.db.get_pending_todos(
+                tag="tag1", at_datetime=datetime.datetime(2011, 1, 2))
+        self.assertEqual(todos, [(datetime.datetime(2011, 1, 1, 10, 31, 10),
+                                  "task3", "Todo for task3")])
+        todos = self.db.get_pending_todos(
+                tag="tag4", at_datetime=datetime.datetime(2011, 1, 2))
+        self.assertEqual(todos, [(datetime.datetime(2011, 1, 1, 10, 31, 20),
+                                  "task4", "Todo for task4")])
+        self.assertRaises(KeyError, self.db.get_pending_todos,
+                          tag="nosuchtag")
+
+
     def test_delete_entries(self):
         self._create_sample_task_logs()
         cur = self.db.conn.cursor()
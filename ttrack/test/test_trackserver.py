@@ -0,0 +1,189 @@
+#!/usr/bin/python
+
+import datetime
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+import urllib
+import urllib2
+
+# Module under test
+import tracklib
+import trackserver
+
+
+class NullHandler(logging.Handler):
+    """Dummy logging handler which does nothing."""
+
+    def emit(self, record):
+        pass
+
+
+class TestTrackServer(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger("test_trackserver")
+        self.logger.addHandler(NullHandler())
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, "timetrackdb")
+        self.db = tracklib.TimeTrackDB(self.logger, filename=self.filename)
+        self.server = trackserver.TrackServer(self.logger, self.filename,
+                                              address=("127.0.0.1", 0),
+                                              pool_size=2)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join(1)
+        del self.db
+        shutil.rmtree(self.tmp_dir)
+
+
+    def _request(self, path, body=None):
+        url = "http://127.0.0.1:%d%s" % (self.server.server_address[1], path)
+        data = json.dumps(body) if body is not None else None
+        try:
+            response = urllib2.urlopen(url, data, timeout=5)
+            return (response.getcode(), json.loads(response.read()))
+        except urllib2.HTTPError, e:
+            return (e.code, json.loads(e.read()))
+
+
+    def test_status(self):
+        startup_time = self.db.info["startup_time"]
+        self.assertEqual(self._request("/status"),
+                         (200, {"current": None, "previous": None}))
+        self.assertEqual(self.db.info["startup_time"], startup_time)
+        self.db.tasks.add("task1")
+        self.db.start_task("task1", datetime.datetime(2013, 3, 26, 10, 0))
+        code, result = self._request("/status")
+        self.assertEqual(code, 200)
+        self.assertEqual(result["current"], {"task": "task1",
+                                             "start": "2013-03-26T10:00:00"})
+
+
+    def test_start_stop(self):
+        self.db.tasks.add("task1")
+        code, result = self._request("/start", {"task": "task1",
+                                                "time": "2013-03-26T10:00:00"})
+        self.assertEqual(code, 200)
+        self.assertEqual(result["current"]["task"], "task1")
+        self.assertEqual(self.db.get_current_task(), "task1")
+        code, result = self._request("/stop", {"time": "2013-03-26T10:30:00"})
+        self.assertEqual(code, 200)
+        self.assertEqual(result, {"current": None,
+                                  "previous": {"task": "task1",
+                                               "duration": 1800}})
+        self.assertEqual(self.db.get_current_task(), None)
+
+
+    def test_names_refresh(self):
+        self.db.tasks.add("task2")
+        self.db.tasks.add("task1")
+        self.assertEqual(self._request("/tasks"),
+                         (200, {"tasks": ["task1", "task2"]}))
+        # Changes made through another connection must be visible.
+        self.db.tasks.add("task3")
+        self.assertEqual(self._request("/tasks"),
+                         (200, {"tasks": ["task1", "task2", "task3"]}))
+        self.db.tags.add("tag1")
+        self.assertEqual(self._request("/tags"), (200, {"tags": ["tag1"]}))
+
+
+    def test_summary(self):
+        self.db.tasks.add("task1")
+        self.db.tasks.add("task2")
+        self.db.start_task("task1", datetime.datetime(2013, 3, 26, 10, 0))
+        self.db.start_task("task2", datetime.datetime(2013, 3, 26, 10, 30))
+        self.db.stop_task(datetime.datetime(2013, 3, 26, 12, 30))
+        code, result = self._request("/summary?start=2013-03-26"
+                                     "&end=2013-03-27")
+        self.assertEqual(code, 200)
+        self.assertEqual(result["time"], {"task1": 1800, "task2": 7200})
+        self.assertEqual(result["switches"], {"task2": 1})
+        code, result = self._request("/summary?period=2013-03-26")
+        self.assertEqual(code, 200)
+        self.assertEqual(result["time"], {"task1": 1800, "task2": 7200})
+        # Cached results must be discarded after changes.
+        self.db.tasks.discard("task2")
+        code, result = self._request("/summary?start=2013-03-26"
+                                     "&end=2013-03-27")
+        self.assertEqual(result["time"], {"task1": 1800})
+
+
+    def test_todos(self):
+        self.db.tasks.add("task1")
+        self.db.add_task_todo("task1", "Do something")
+        code, result = self._request("/todos?task=task1")
+        self.assertEqual(code, 200)
+        self.assertEqual(len(result["todos"]), 1)
+        self.assertEqual(result["todos"][0]["task"], "task1")
+        self.assertEqual(result["todos"][0]["description"], "Do something")
+
+
+    def test_entries(self):
+        self.db.tasks.add("task1")
+        self.db.tasks.add("task2")
+        for hour in xrange(10, 15):
+            self.db.start_task("task%d" % (hour % 2 + 1,),
+                               datetime.datetime(2013, 3, 26, hour, 0))
+        code, result = self._request("/entries?limit=3")
+        self.assertEqual(code, 200)
+        self.assertEqual([i["start"] for i in result["entries"]],
+                         ["2013-03-26T14:00:00", "2013-03-26T13:00:00",
+                          "2013-03-26T12:00:00"])
+        self.assertEqual(result["entries"][0]["end"], None)
+        self.assertEqual(result["entries"][1], {"id": 4, "task": "task2",
+                                                "start": "2013-03-26T13:00:00",
+                                                "end": "2013-03-26T14:00:00"})
+        code, result = self._request("/entries?limit=3&after="
+                                     + urllib.quote(result["next"]))
+        self.assertEqual(code, 200)
+        self.assertEqual([i["start"] for i in result["entries"]],
+                         ["2013-03-26T11:00:00", "2013-03-26T10:00:00"])
+        self.assertEqual(result["next"], None)
+        self.assertEqual(self._request("/entries?limit=0")[0], 400)
+        self.assertEqual(self._request("/entries?after=junk")[0], 400)
+
+
+    def test_errors(self):
+        self.assertEqual(self._request("/nonexistent")[0], 404)
+        self.assertEqual(self._request("/start", {"task": "nosuchtask"})[0],
+                         404)
+        self.assertEqual(self._request("/start", {})[0], 400)
+        self.assertEqual(self._request("/summary?by=foo")[0], 400)
+        self.assertEqual(self._request("/summary?period=not+a+period")[0],
+                         400)
+
+
+    def test_internal_errors(self):
+        def locked(handler, state, query):
+            raise sqlite3.OperationalError("database is locked")
+        def broken(handler, state, query):
+            raise ValueError("broken")
+        original = trackserver.TrackRequestHandler.get_tasks
+        try:
+            trackserver.TrackRequestHandler.get_tasks = locked
+            code, result = self._request("/tasks")
+            self.assertEqual(code, 503)
+            self.assertIn("database is locked", result["error"])
+            trackserver.TrackRequestHandler.get_tasks = broken
+            code, result = self._request("/tasks")
+            self.assertEqual(code, 500)
+            self.assertIn("broken", result["error"])
+        finally:
+            trackserver.TrackRequestHandler.get_tasks = original
+
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,210 @@
+#!/usr/bin/python
+
+import imp
+import logging
+import os
+import socket
+import StringIO
+import sys
+import unittest
+
+# Script under test, which can't be imported by name as it has no extension.
+ttrack = imp.new_module("ttrack")
+ttrack.__file__ = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               os.pardir, "bin", "ttrack")
+execfile(ttrack.__file__, ttrack.__dict__)
+
+
+class NullHandler(logging.Handler):
+    """Dummy logging handler which does nothing."""
+
+    def emit(self, record):
+        pass
+
+
+class ShortReadSocket(object):
+    """Wraps a socket so that each recv() returns at most one byte."""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+
+    def recv(self, length):
+        return self.sock.recv(1)
+
+
+
+class RecordingSocket(object):
+    """Records the data passed to each sendall() instead of sending it."""
+
+    def __init__(self):
+        self.sent = []
+
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+
+
+class TestDaemonProtocol(unittest.TestCase):
+
+    def setUp(self):
+        self.client, self.server = socket.socketpair()
+
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+
+    def test_frames(self):
+        ttrack.send_frame(self.server, "o", "hello\n")
+        ttrack.send_frame(self.server, "x", "")
+        self.assertEqual(ttrack.recv_frame(self.client), ("o", "hello\n"))
+        self.assertEqual(ttrack.recv_frame(self.client), ("x", ""))
+        ttrack.send_frame(self.server, "e", "short reads")
+        self.assertEqual(ttrack.recv_frame(ShortReadSocket(self.client)),
+                         ("e", "short reads"))
+        self.server.close()
+        self.assertEqual(ttrack.recv_frame(self.client), None)
+
+
+    def test_eof_mid_frame(self):
+        self.server.sendall(ttrack.FRAME_HEADER.pack("o", 10) + "12345")
+        self.server.close()
+        self.assertEqual(ttrack.recv_frame(self.client), None)
+
+
+    def test_oversized_frames(self):
+        # Large writes are split, but the receiver rejects frames which
+        # are too large rather than trying to read them.
+        sock = RecordingSocket()
+        ttrack.send_frame(sock, "o", "x" * (ttrack.MAX_FRAME_SIZE + 10))
+        self.assertEqual([len(i) for i in sock.sent],
+                         [ttrack.FRAME_HEADER.size + ttrack.MAX_FRAME_SIZE,
+                          ttrack.FRAME_HEADER.size + 10])
+        header = ttrack.FRAME_HEADER.pack("o", ttrack.MAX_FRAME_SIZE + 1)
+        self.server.sendall(header)
+        self.assertEqual(ttrack.recv_frame(self.client), None)
+
+
+    def test_client_args(self):
+        self.assertEqual(ttrack.get_client_args(["ttrack"]), None)
+        self.assertEqual(ttrack.get_client_args(["ttrack", "status"]),
+                         ["status"])
+        self.assertEqual(ttrack.get_client_args(["ttrack", "diary",
+                                                 "Fixed the bug"]),
+                         ["diary", "Fixed the bug"])
+        self.assertEqual(ttrack.get_client_args(["ttrack", "-M", "status"]),
+                         None)
+        self.assertEqual(ttrack.get_client_args(["ttrack", "summary", "-x"]),
+                         None)
+        self.assertEqual(ttrack.get_client_args(["ttrack", "delete", "task",
+                                                 "task1"]), None)
+        self.assertEqual(ttrack.get_client_args(["ttrack", "diary"]), None)
+
+
+    def test_serve_client(self):
+        logger = logging.getLogger("test_ttrack")
+        logger.addHandler(NullHandler())
+        interpreter = ttrack.CommandHandler(logger, ":memory:")
+        self.client.sendall("\0".join(("create", "task", "task 1")) + "\n")
+        ttrack.serve_daemon_client(interpreter, logger, self.server)
+        output = []
+        frame = ttrack.recv_frame(self.client)
+        while frame[0] == "o":
+            output.append(frame[1])
+            frame = ttrack.recv_frame(self.client)
+        self.assertEqual(frame, ("x", "0"))
+        self.assertEqual("".join(output), "Created task 'task 1'\n")
+        self.assertEqual(list(interpreter.db.tasks), ["task 1"])
+
+
+
+
+class TestRunScript(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger("test_ttrack")
+        self.logger.addHandler(NullHandler())
+        self.interpreter = ttrack.CommandHandler(self.logger, ":memory:")
+
+
+    def _run_script(self, lines, **kwargs):
+        script = StringIO.StringIO("".join(i + "\n" for i in lines))
+        old_stdout, old_stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+        try:
+            failures = ttrack.run_script(self.interpreter, self.logger, script,
+                                         **kwargs)
+            return (failures, sys.stdout.getvalue(), sys.stderr.getvalue())
+        finally:
+            sys.stdout, sys.stderr = old_stdout, old_stderr
+
+
+    def test_output(self):
+        self.assertEqual(self._run_script(["create task task1"]),
+                         (0, "ttrack>>> create task task1\n"
+                             "Created task 'task1'\n", ""))
+        failures, output, errors = self._run_script(["create task task2",
+                                                     "# comment", "",
+                                                     "start nosuchtask"],
+                                                    quiet=True)
+        self.assertEqual((failures, output), (1, ""))
+        self.assertTrue(errors.startswith("ttrack>>> start nosuchtask\n"
+                                          "Error: "))
+        self.assertEqual(set(self.interpreter.db.tasks),
+                         set(("task1", "task2")))
+
+
+    def test_transaction(self):
+        self.assertRaises(ttrack.ApplicationError, self._run_script,
+                          ["create task task1", "start nosuchtask"],
+                          quiet=True, transaction=True)
+        self.assertEqual(list(self.interpreter.db.tasks), [])
+
+
+
+class TestTodoToken(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger("test_ttrack")
+        self.logger.addHandler(NullHandler())
+
+
+    def _create_interpreter(self, todos):
+        interpreter = ttrack.CommandHandler(self.logger, ":memory:")
+        interpreter.db.tasks.add("task1")
+        interpreter.db.start_task("task1")
+        for todo in todos:
+            interpreter.db.add_task_todo("task1", todo)
+        return interpreter
+
+
+    def test_complete(self):
+        token = ttrack.TodoToken("todo")
+        interpreter = self._create_interpreter(["Fix the widget",
+                                                "Fix Bob's gadget"])
+        self.assertEqual(sorted(token.complete_items([], "Fi", interpreter)),
+                         ["Fix Bob\\'s gadget", "Fix the widget"])
+        self.assertEqual(token.complete_items(["Fix", "the"], "",
+                                              interpreter), ["widget"])
+
+        # Another context must not be given the first one's todos, even if
+        # its database is at the same version.
+        other = self._create_interpreter(["Polish the gizmo"])
+        self.assertEqual(token.complete_items([], "", other),
+                         ["Polish the gizmo"])
+
+        old_stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            interpreter.onecmd("todo done the widget")
+        finally:
+            sys.stdout = old_stdout
+        self.assertEqual(token.complete_items([], "Fi", interpreter),
+                         ["Fix Bob\\'s gadget"])
+
+
+
+if __name__ == "__main__":
+    unittest.main()